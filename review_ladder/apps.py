@@ -1,12 +1,25 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 class ReviewLadderConfig(AppConfig):
     name = 'review_ladder'
     verbose_name = "Review Ladder"
 
     def ready(self):
+        from django.db.backends.signals import connection_created
+        from .db import setup_sqlite
         from .github import GithubImporter
+        from .ranking import get_engine
+        from .webhooks import WebhookWorker
         import sys
 
+        # fails early if the ranking engine is misconfigured
+        get_engine()
+        if getattr(settings, "REVIEW_LADDER_SQLITE_WAL", False):
+            connection_created.connect(setup_sqlite)
         if not sys.argv[0].endswith("manage.py") or (sys.argv[1] in ["runserver"]):
-            GithubImporter().start()
+            # can be run as a separate process with the run_importer command
+            if getattr(settings, "REVIEW_LADDER_IMPORTER_THREAD", True):
+                GithubImporter().start()
+            if getattr(settings, "REVIEW_LADDER_WEBHOOK_WORKER", True):
+                WebhookWorker().start()
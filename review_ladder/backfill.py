@@ -0,0 +1,193 @@
+from django.conf import settings
+from django.db import connections
+from django.db.utils import IntegrityError, OperationalError
+from django.utils import timezone
+from django.utils.six.moves import queue as queues
+
+import dateutil.parser
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+
+from .cache import bump_generation
+from . import eventstore
+from .github import CLIENT, GITHUB_REPO, SYNC_OVERLAP
+from .github import fetch_pr, json_pr_page, json_pull
+from .models import BackfillShard, FailedImport, SyncState, START_DATE
+from .models import normalize_date
+from .writer import BulkWriter
+
+# The backfill splits the listing of all PRs (oldest first) into shards of
+# consecutive pages. Each shard is fetched by a worker process, while the
+# fetched pages are written to the database by the parent process only, which
+# checkpoints the next page of each shard after writing a page. An interrupted
+# backfill thus resumes where it stopped.
+
+LOGGER = logging.getLogger(__name__)
+
+def _fetch_page(page, repo):
+    json_prs, _ = json_pr_page(page, repo=repo)
+    prs = []
+    failed = []
+    for json_pr in json_prs:
+        if hasattr(settings, "GITHUB_SINCE") and \
+           (normalize_date(dateutil.parser.parse(json_pr["updated_at"])) <
+            normalize_date(START_DATE)):
+            continue
+        try:
+            prs.append(fetch_pr(json_pr, repo))
+        except Exception as e:
+            failed.append((json_pr["number"], repr(e)))
+    return prs, failed
+
+def _put(queue, message, parent):
+    while True:
+        try:
+            queue.put(message, timeout=1)
+            return
+        except queues.Full:
+            if os.getppid() != parent:
+                # nobody is going to take it anymore
+                os._exit(1)
+
+def _fetch_shard(shard, queue, parent, share):
+    # runs in a worker process. The connections inherited from the parent
+    # must not be shared with it and the rate limit is shared with the other
+    # workers.
+    CLIENT.session.close()
+    CLIENT.share = share
+    try:
+        for page in range(shard.next_page, shard.last_page + 1):
+            prs, failed = _fetch_page(page, shard.repo)
+            _put(queue, ("page", shard.pk, page, prs, failed), parent)
+    except Exception:
+        _put(queue, ("error", shard.pk, traceback.format_exc()), parent)
+    else:
+        _put(queue, ("done", shard.pk, None), parent)
+
+class Progress(object):
+    def __init__(self, total, unit="pages"):
+        self.total = total
+        self.unit = unit
+        self.done = 0
+        self.prs = 0
+        self.failed = 0
+        self.started = time.time()
+
+    @property
+    def seconds(self):
+        return time.time() - self.started
+
+    @property
+    def prs_per_second(self):
+        return self.prs / max(self.seconds, 1e-6)
+
+    def __str__(self):
+        return "%d/%d %s, %d PRs (%.1f PRs/s), %d failed" % (
+                self.done, self.total, self.unit, self.prs,
+                self.prs_per_second, self.failed
+            )
+
+def _write(writer, repo, prs, failed):
+    # returns the number of PRs that could not be imported
+    numbers = [data["pr"]["number"] for data in prs]
+    try:
+        for data in prs:
+            eventstore.record("pr", repo, data)
+            if writer.add(data):
+                writer.flush()
+        writer.flush()
+    except (IntegrityError, OperationalError) as e:
+        LOGGER.warning("Writing PRs %s failed: %s" % (numbers, e))
+        failed = failed + [(number, repr(e)) for number in numbers]
+        numbers = []
+    finally:
+        eventstore.flush()
+        bump_generation()
+    FailedImport.objects.filter(repo=repo, number__in=numbers).delete()
+    for number, error in failed:
+        FailedImport.record(repo, number, error)
+    return len(failed)
+
+def backfill(workers=4, shards=None, repo=GITHUB_REPO, report=None):
+    # imports all PRs of repo with workers processes, calling report with the
+    # Progress after each page
+    started = timezone.now()
+    _, pages = json_pr_page(1, repo=repo)
+    plan = BackfillShard.plan(repo, pages, shards or workers)
+    # pages imported by an interrupted run may be older
+    started = min([started] + [shard.created for shard in plan])
+    pending = [shard for shard in plan if not shard.done]
+    progress = Progress(sum(shard.last_page - shard.next_page + 1
+                            for shard in pending))
+    # the workers inherit the set up Django (settings, apps) from this
+    # process, which only forking does (spawn is the default on some
+    # platforms and Python versions)
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue(maxsize=2 * workers)
+    # each worker gets an equal part of the remaining rate limit
+    share = 1. / max(min(workers, len(pending)), 1)
+    running = {}
+    errors = []
+    writer = BulkWriter(repo)
+    while pending or running:
+        while pending and (len(running) < workers):
+            shard = pending.pop(0)
+            # forked processes must not share the database connections
+            connections.close_all()
+            process = context.Process(target=_fetch_shard,
+                                      args=(shard, queue, os.getpid(), share))
+            process.daemon = True
+            process.start()
+            running[shard.pk] = process
+        try:
+            message = queue.get(timeout=1)
+        except queues.Empty:
+            for pk, process in list(running.items()):
+                if not process.is_alive() and process.exitcode:
+                    errors.append("Worker of shard %d died (exit code %d)" %
+                                  (pk, process.exitcode))
+                    del running[pk]
+            continue
+        kind, pk = message[:2]
+        if kind == "page":
+            page, prs, failed = message[2:]
+            progress.failed += _write(writer, repo, prs, failed)
+            BackfillShard.objects.filter(pk=pk).update(next_page=page + 1)
+            progress.done += 1
+            progress.prs += len(prs)
+            if report:
+                report(progress)
+        else:
+            if kind == "error":
+                errors.append(message[2])
+            running.pop(pk).join()
+    if errors:
+        raise RuntimeError("Backfill incomplete, run it again to resume:\n%s"
+                           % "\n".join(errors))
+    BackfillShard.objects.filter(repo=repo).delete()
+    # the regular imports only need to catch up from here
+    SyncState.objects.get_or_create(
+            repo=repo, defaults={"watermark": started - SYNC_OVERLAP}
+        )
+    return progress
+
+def retry_failed(repo=GITHUB_REPO, report=None):
+    # imports the PRs that failed before again
+    failed = list(FailedImport.objects.filter(repo=repo)
+                                      .values_list("number", flat=True))
+    progress = Progress(len(failed), "PRs")
+    writer = BulkWriter(repo)
+    for number in failed:
+        try:
+            prs, errors = [fetch_pr(json_pull(number, repo), repo)], []
+        except Exception as e:
+            prs, errors = [], [(number, repr(e))]
+        progress.failed += _write(writer, repo, prs, errors)
+        progress.done += 1
+        progress.prs += len(prs)
+        if report:
+            report(progress)
+    return progress
@@ -0,0 +1,279 @@
+from django.utils.six.moves import BaseHTTPServer, socketserver
+from django.utils.six.moves.urllib.parse import parse_qsl, urlencode, urlparse
+
+import collections
+import json
+import re
+import threading
+import time
+from hashlib import md5
+
+class _Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class FakeGithub(object):
+    # A local stand-in for the parts of the GitHub REST and GraphQL APIs the
+    # importer uses, serving a synthetic.SyntheticRepository. Lists are
+    # paginated with Link headers, responses carry ETags and rate limit headers
+    # and budget requests per window are granted before answering with 403,
+    # like GitHub does. latency is added to every response.
+    HOOKS = ["127.0.0.0/8", "::1/128"]
+
+    def __init__(self, repository, per_page=30, budget=10 ** 9, window=3600,
+                 latency=0, host="127.0.0.1", port=0):
+        self.repository = repository
+        self.per_page = per_page
+        self.budget = budget
+        self.window = window
+        self.latency = latency
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+        self.reset = 0
+        self.remaining = budget
+        self.commits = dict((data["commit"]["sha"], data["commit"])
+                            for data in repository.prs.values()
+                            if data["commit"])
+        fake = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body are sent separately
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake.handle(self)
+
+            def do_POST(self):
+                fake.handle(self)
+
+        self.server = _Server((host, port), Handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server.server_address[:2]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _rate_limit(self):
+        # returns the rate limit headers and if the request is within budget
+        with self.lock:
+            now = time.time()
+            if now >= self.reset:
+                self.reset = int(now) + self.window
+                self.remaining = self.budget
+            allowed = self.remaining > 0
+            if allowed:
+                self.remaining -= 1
+            return [
+                    ("x-ratelimit-limit", str(self.budget)),
+                    ("x-ratelimit-remaining", str(self.remaining)),
+                    ("x-ratelimit-reset", str(self.reset)),
+                    ("x-ratelimit-resource", "core"),
+                ], allowed
+
+    def _page(self, request, path, query, items):
+        page = int(query.get("page", 1))
+        per_page = min(int(query.get("per_page", self.per_page)), 100)
+        last = max(1, (len(items) + per_page - 1) // per_page)
+        params = [(k, v) for k, v in sorted(query.items()) if k != "page"]
+        links = []
+        for rel, number in [("prev", page - 1), ("next", page + 1),
+                            ("first", 1), ("last", last)]:
+            if (1 <= number <= last) and (number != page):
+                # page goes last, like in GitHub's links
+                links.append('<http://%s%s?%s>; rel="%s"' % (
+                        request.headers.get("Host"), path,
+                        urlencode(params + [("page", number)]), rel
+                    ))
+        start = (page - 1) * per_page
+        return items[start:start + per_page], ", ".join(links) or None
+
+    def _prs(self, query):
+        prs = [data["pr"] for data in self.repository.prs.values()]
+        if query.get("sort") == "updated":
+            key = lambda pr: pr["updated_at"]
+        else:
+            key = lambda pr: pr["created_at"]
+        return sorted(prs, key=key, reverse=query.get("direction") != "asc")
+
+    def _route(self, request, path, query):
+        # returns the endpoint name, the body and the Link header
+        prs = self.repository.prs
+        match = re.match(r"^/repos/[^/]+/[^/]+/(\w+)(?:/(\w+))?(?:/(\w+))?$",
+                         path)
+        if path == "/meta":
+            return "meta", {"hooks": self.HOOKS}, None
+        elif path == "/graphql":
+            return "graphql", self.graphql(request), None
+        elif path == "/search/issues":
+            # search results lack the merge information
+            items = [dict((k, v) for k, v in pr.items()
+                          if k not in ["merged_at", "merge_commit_sha"])
+                     for pr in self._prs({"sort": "updated"})]
+            items, link = self._page(request, path, query, items)
+            return "search", {"total_count": len(prs), "items": items}, link
+        elif match is None:
+            return None, None, None
+        collection, id, sub = match.groups()
+        if collection == "commits" and not sub:
+            return "commits", self.commits.get(id), None
+        elif collection not in ["pulls", "issues"]:
+            return None, None, None
+        elif id is None:
+            if collection != "pulls":
+                return None, None, None
+            return ("pulls",) + self._page(request, path, query,
+                                            self._prs(query))
+        elif not id.isdigit() or int(id) not in prs:
+            return collection, None, None
+        data = prs[int(id)]
+        if (collection, sub) == ("pulls", None):
+            return "pull", data["pr"], None
+        elif (collection, sub) in [("issues", "events"),
+                                   ("pulls", "comments"),
+                                   ("pulls", "reviews")]:
+            return (sub,) + self._page(request, path, query, data[sub])
+        return None, None, None
+
+    def handle(self, request):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(request.path)
+        query = dict(parse_qsl(url.query))
+        status = 200
+        try:
+            endpoint, body, link = self._route(request, url.path, query)
+        except (ValueError, KeyError, AttributeError) as e:
+            endpoint, link = None, None
+            status, body = 400, {"message": "Problems parsing request: %s" % e}
+        headers, allowed = self._rate_limit()
+        if body is None:
+            status, body = 404, {"message": "Not Found"}
+        elif not allowed:
+            status, body = 403, {"message": "API rate limit exceeded"}
+        content = json.dumps(body).encode("utf-8")
+        etag = 'W/"%s"' % md5(content).hexdigest()
+        if (status == 200) and (request.command == "GET") and \
+           (request.headers.get("If-None-Match") == etag):
+            # conditional requests are not counted against the rate limit
+            with self.lock:
+                self.remaining += 1
+            status, content = 304, b""
+        with self.lock:
+            self.requests[endpoint, status] += 1
+        request.send_response(status)
+        for header in headers:
+            request.send_header(*header)
+        if status in [200, 304]:
+            request.send_header("ETag", etag)
+            if link:
+                request.send_header("Link", link)
+        request.send_header("Content-Type", "application/json; charset=utf-8")
+        request.send_header("Content-Length", str(len(content)))
+        request.end_headers()
+        request.wfile.write(content)
+
+    @staticmethod
+    def _user(json_user):
+        return {
+                "login": json_user["login"],
+                "avatarUrl": json_user["avatar_url"],
+                "databaseId": json_user["id"],
+            }
+
+    @staticmethod
+    def _connection(nodes, first):
+        return {"pageInfo": {"hasNextPage": len(nodes) > first},
+                "nodes": nodes[:first]}
+
+    def _node(self, data, nested):
+        json_pr = data["pr"]
+        events = []
+        for json_event in data["events"]:
+            if json_event["event"] == "assigned":
+                events.append({"__typename": "AssignedEvent",
+                               "assignee": self._user(json_event["assignee"])})
+            elif json_event["event"] == "review_requested":
+                # teams are no actors, so none of their fields are queried
+                events.append({
+                        "__typename": "ReviewRequestedEvent",
+                        "requestedReviewer":
+                            self._user(json_event["requested_reviewer"])
+                            if json_event.get("requested_reviewer") else {},
+                    })
+        reviews = [{
+                "databaseId": json_review["id"],
+                "state": json_review["state"],
+                "submittedAt": json_review["submitted_at"],
+                "author": self._user(json_review["user"]),
+                "comments": self._connection([], nested),
+            } for json_review in data["reviews"]]
+        if data["comments"]:
+            # review comments always belong to a review in GraphQL
+            if not reviews:
+                reviews.append({
+                        "databaseId": 0,
+                        "state": "PENDING",
+                        "submittedAt": None,
+                        "author": self._user(json_pr["user"]),
+                    })
+            reviews[0]["comments"] = self._connection([{
+                    "databaseId": json_comment["id"],
+                    "createdAt": json_comment["created_at"],
+                    "author": self._user(json_comment["user"]),
+                } for json_comment in data["comments"]], nested)
+        merge_commit = None
+        if data["commit"]:
+            merge_commit = {
+                    "oid": data["commit"]["sha"],
+                    "author": {
+                        "date": data["commit"]["commit"]["author"]["date"],
+                        "user": self._user(data["commit"]["author"]),
+                    },
+                }
+        return {
+                "number": json_pr["number"],
+                "state": "MERGED" if json_pr["merged_at"] else "OPEN",
+                "updatedAt": json_pr["updated_at"],
+                "mergedAt": json_pr["merged_at"],
+                "author": self._user(json_pr["user"]),
+                "mergeCommit": merge_commit,
+                "timelineItems": self._connection(events, nested),
+                "reviews": self._connection(reviews, nested),
+            }
+
+    def graphql(self, request):
+        # only knows the query of graphql.PRS_QUERY
+        length = int(request.headers.get("Content-Length", 0))
+        body = json.loads(request.rfile.read(length).decode("utf-8"))
+        variables = body["variables"]
+        nested = int(re.search(r"timelineItems\(first: (\d+)",
+                               body["query"]).group(1))
+        start = int(variables.get("cursor") or 0)
+        end = start + variables["count"]
+        prs = [self.repository.prs[pr["number"]]
+               for pr in self._prs({"sort": "updated"})]
+        return {"data": {"repository": {"pullRequests": {
+                "pageInfo": {"hasNextPage": end < len(prs),
+                             "endCursor": str(end)},
+                "nodes": [self._node(data, nested) for data in prs[start:end]],
+            }}}}
@@ -0,0 +1,196 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.urls import reverse
+from django.test import Client
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+
+import contextlib
+import datetime
+import hmac
+import json
+import time
+from hashlib import sha1
+
+from .. import github, graphql
+from ..models import Comment, DailyScore, Merge, PullRequest, SyncState, User
+from ..models import WebhookDelivery
+from ..webhooks import process_queue
+from .fakegithub import FakeGithub
+from .synthetic import SyntheticRepository
+
+# Each benchmark yields its results as dicts that can be serialized to JSON.
+# They write to the database, so they should only run against a scratch one
+# (the benchmark command uses a test database).
+
+BENCH_CACHE = "review_ladder_bench"
+BENCH_HTTP_CACHE = "review_ladder_bench_http"
+
+@contextlib.contextmanager
+def isolated_caches():
+    # keeps the HTTP cache and the ladder caches away from the configured ones
+    # (and from each other)
+    aliases = dict(settings.CACHES)
+    aliases[BENCH_CACHE] = {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": BENCH_CACHE,
+        }
+    # holds a response per page of every list, which must not be culled
+    aliases[BENCH_HTTP_CACHE] = {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": BENCH_HTTP_CACHE,
+            "OPTIONS": {"MAX_ENTRIES": 10 ** 6},
+        }
+    with override_settings(CACHES=aliases, GITHUB_HTTP_CACHE=BENCH_HTTP_CACHE,
+                           REVIEW_LADDER_CACHE=BENCH_CACHE):
+        yield
+
+@contextlib.contextmanager
+def fake_github(repository, **kwargs):
+    # points the importer to a FakeGithub serving repository
+    with FakeGithub(repository, **kwargs) as fake:
+        graphql_api = graphql.GITHUB_GRAPHQL_API
+        graphql.GITHUB_GRAPHQL_API = "%s/graphql" % fake.url
+        try:
+            with override_settings(GITHUB_API=fake.url):
+                yield fake
+        finally:
+            graphql.GITHUB_GRAPHQL_API = graphql_api
+
+def clear():
+    for model in [WebhookDelivery, DailyScore, Merge, Comment, PullRequest,
+                  SyncState, User]:
+        model.objects.all().delete()
+    for alias in [BENCH_CACHE, BENCH_HTTP_CACHE]:
+        if alias in settings.CACHES:
+            caches[alias].clear()
+
+def timings(func, repeat=1):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    times.sort()
+    return {
+            "min": times[0],
+            "median": times[len(times) // 2],
+            "max": times[-1],
+        }
+
+def dataset_size():
+    return {
+            "users": User.objects.count(),
+            "prs": PullRequest.objects.count(),
+            "comments": Comment.objects.count(),
+            "merges": Merge.objects.count(),
+            "daily_scores": DailyScore.objects.count(),
+        }
+
+def bench_ranking(sizes=(1000,), windows=(7, 30, 365, None), repeat=10,
+                  **dataset):
+    # latency of an uncached ranking by history size and window width (in
+    # days, None for the whole history)
+    for prs in sizes:
+        clear()
+        repository = SyntheticRepository(prs=prs, **dataset)
+        populate = timings(repository.populate)
+        size = dataset_size()
+        for days in windows:
+            since = None
+            if days is not None:
+                since = timezone.now() - datetime.timedelta(days=days)
+            yield {
+                    "benchmark": "ranking",
+                    "dataset": size,
+                    "populate_seconds": populate["min"],
+                    "window_days": days,
+                    "seconds": timings(lambda: User.get_ranking(since=since),
+                                       repeat),
+                }
+
+def _requests(fake):
+    total = sum(fake.requests.values())
+    not_modified = sum(count for (_, status), count in fake.requests.items()
+                       if status == 304)
+    fake.requests.clear()
+    return {"total": total, "not_modified": not_modified}
+
+def bench_import(prs=1000, backend="rest", workers=1, touched=10,
+                 latency=0, **dataset):
+    # throughput of a full import into an empty database and of an
+    # incremental one after touched PRs were updated
+    clear()
+    repository = SyntheticRepository(prs=prs, **dataset)
+    with fake_github(repository, latency=latency) as fake, \
+         override_settings(GITHUB_IMPORT_BACKEND=backend):
+        for kind in ["full", "incremental"]:
+            if kind == "incremental":
+                repository.touch(touched)
+            start = time.time()
+            github.import_models(workers=workers)
+            seconds = time.time() - start
+            imported = prs if kind == "full" else touched
+            yield {
+                    "benchmark": "import",
+                    "kind": kind,
+                    "backend": backend,
+                    "workers": workers,
+                    "latency": latency,
+                    "prs": imported,
+                    "dataset": dataset_size(),
+                    "seconds": seconds,
+                    "prs_per_second": imported / seconds,
+                    "requests": _requests(fake),
+                }
+
+def bench_webhook(prs=1000, events=1000, batch_size=100, **dataset):
+    # requests/sec of the webhook view and deliveries/sec of the queue
+    clear()
+    repository = SyntheticRepository(prs=prs, **dataset)
+    repository.populate()
+    deliveries = [(event, json.dumps(payload)) for event, payload in
+                  repository.webhook_payloads(events)]
+    client = Client()
+    with fake_github(repository):
+        # the fake serves the loopback networks as hook networks
+        github.HOOK_NETWORKS.refresh()
+        start = time.time()
+        for i, (event, body) in enumerate(deliveries):
+            headers = {
+                    "HTTP_X_GITHUB_EVENT": event,
+                    "HTTP_X_GITHUB_DELIVERY": "bench-%d" % i,
+                    "HTTP_X_FORWARDED_FOR": "127.0.0.1",
+                }
+            if hasattr(settings, "GITHUB_WEBHOOK_KEY"):
+                mac = hmac.new(force_bytes(settings.GITHUB_WEBHOOK_KEY),
+                               msg=force_bytes(body), digestmod=sha1)
+                headers["HTTP_X_HUB_SIGNATURE"] = "sha1=%s" % mac.hexdigest()
+            res = client.post(reverse("webhook"), body,
+                              content_type="application/json", **headers)
+            if res.status_code != 202:
+                raise RuntimeError("Webhook answered %d: %s" %
+                                   (res.status_code, res.content))
+        received = time.time() - start
+        start = time.time()
+        while process_queue(batch_size):
+            pass
+        processed = time.time() - start
+    github.HOOK_NETWORKS.expires = 0
+    yield {
+            "benchmark": "webhook",
+            "events": events,
+            "batch_size": batch_size,
+            "dataset": dataset_size(),
+            "receive_seconds": received,
+            "requests_per_second": events / received,
+            "process_seconds": processed,
+            "processed_per_second": events / processed,
+        }
+
+BENCHMARKS = {
+        "ranking": bench_ranking,
+        "import": bench_import,
+        "webhook": bench_webhook,
+    }
@@ -0,0 +1,162 @@
+import collections
+import datetime
+import random
+
+from ..models import GITHUB_REPO
+from ..writer import BulkWriter
+
+def timestamp(date):
+    return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+class SyntheticRepository(object):
+    # A reproducible, randomly generated repository with the data of each PR
+    # in the shape github.fetch_pr returns it. Activity is spread over the
+    # last days days, the numbers of comments, reviews and assignments are
+    # averages per PR and merged is the share of merged PRs.
+    REVIEW_STATES = ["APPROVED", "CHANGES_REQUESTED", "COMMENTED", "PENDING"]
+    ACTIVITY = datetime.timedelta(days=30)
+
+    def __init__(self, users=50, prs=1000, comments=5, reviews=2, merged=.6,
+                 assignments=1, days=3 * 365, seed=0, repo=GITHUB_REPO):
+        self.random = random.Random(seed)
+        self.repo = repo
+        self.end = datetime.datetime.utcnow().replace(microsecond=0)
+        self.start = self.end - datetime.timedelta(days=days)
+        self.users = [self._user(id) for id in range(1, users + 1)]
+        self.last_id = 0
+        self.prs = collections.OrderedDict()
+        for number in range(1, prs + 1):
+            self.prs[number] = self._pr(number, comments, reviews, merged,
+                                        assignments)
+
+    @staticmethod
+    def _user(id):
+        return {
+                "id": id,
+                "login": "user%d" % id,
+                "avatar_url": "https://avatars.example.org/u/%d" % id,
+            }
+
+    def _next_id(self):
+        self.last_id += 1
+        return self.last_id
+
+    def _count(self, average):
+        return int(round(self.random.uniform(0, 2 * average)))
+
+    def _date(self, start, end):
+        seconds = int((end - start).total_seconds())
+        return start + datetime.timedelta(seconds=self.random.randint(0,
+                                                                      seconds))
+
+    def _pr(self, number, comments, reviews, merged, assignments):
+        created = self._date(self.start, self.end)
+        end = min(created + self.ACTIVITY, self.end)
+        data = {
+                "pr": {
+                    "number": number,
+                    "user": self.random.choice(self.users),
+                    "state": "open",
+                    "created_at": timestamp(created),
+                    "updated_at": timestamp(created),
+                    "merged_at": None,
+                    "merge_commit_sha": None,
+                },
+                "events": [],
+                "comments": [],
+                "reviews": [],
+                "commit": None,
+            }
+        for _ in range(self._count(assignments)):
+            if self.random.random() < .5:
+                data["events"].append({"event": "assigned",
+                                       "assignee": self.random.choice(self.users)})
+            else:
+                data["events"].append({
+                        "event": "review_requested",
+                        "requested_reviewer": self.random.choice(self.users)
+                    })
+        for _ in range(self._count(comments)):
+            data["comments"].append({
+                    "id": self._next_id(),
+                    "user": self.random.choice(self.users),
+                    "created_at": timestamp(self._date(created, end)),
+                })
+        for _ in range(self._count(reviews)):
+            data["reviews"].append({
+                    "id": self._next_id(),
+                    "user": self.random.choice(self.users),
+                    "state": self.random.choice(self.REVIEW_STATES),
+                    "submitted_at": timestamp(self._date(created, end)),
+                })
+        if self.random.random() < merged:
+            date = timestamp(end)
+            sha = "%040x" % self.random.getrandbits(160)
+            data["pr"].update(state="closed", merged_at=date,
+                              merge_commit_sha=sha)
+            data["commit"] = {
+                    "sha": sha,
+                    "author": self.random.choice(self.users),
+                    "commit": {"author": {"date": date}},
+                }
+        self._updated(data)
+        return data
+
+    def _updated(self, data):
+        dates = [data["pr"]["created_at"]]
+        dates.extend(c["created_at"] for c in data["comments"])
+        dates.extend(r["submitted_at"] for r in data["reviews"])
+        if data["pr"]["merged_at"]:
+            dates.append(data["pr"]["merged_at"])
+        # all timestamps have the same format, so they sort as strings
+        data["pr"]["updated_at"] = max(dates)
+
+    def populate(self, chunk_size=500):
+        # writes the repository directly into the database
+        writer = BulkWriter(self.repo, chunk_size)
+        for data in self.prs.values():
+            if writer.add(data):
+                writer.flush()
+        writer.flush()
+
+    def touch(self, count):
+        # comments on count random PRs now, returns their numbers
+        now = timestamp(datetime.datetime.utcnow())
+        numbers = self.random.sample(list(self.prs), min(count, len(self.prs)))
+        for number in numbers:
+            data = self.prs[number]
+            data["comments"].append({
+                    "id": self._next_id(),
+                    "user": self.random.choice(self.users),
+                    "created_at": now,
+                })
+            self._updated(data)
+        return numbers
+
+    def webhook_payloads(self, count):
+        # yields count (event, payload) pairs of new reviews and comments on
+        # random PRs, as GitHub would deliver them
+        now = timestamp(datetime.datetime.utcnow())
+        numbers = list(self.prs)
+        for _ in range(count):
+            data = self.prs[self.random.choice(numbers)]
+            payload = {
+                    "repository": {"full_name": self.repo},
+                    "pull_request": data["pr"],
+                    "sender": self.random.choice(self.users),
+                }
+            if self.random.random() < .5:
+                payload.update(action="submitted", review={
+                        "id": self._next_id(),
+                        "user": payload["sender"],
+                        "state": self.random.choice(self.REVIEW_STATES[:3]),
+                        "submitted_at": now,
+                    })
+                yield "pull_request_review", payload
+            else:
+                payload.update(action="created", comment={
+                        "id": self._next_id(),
+                        "user": payload["sender"],
+                        "created_at": now,
+                    })
+                yield "pull_request_review_comment", payload
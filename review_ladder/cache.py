@@ -0,0 +1,101 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Max
+
+import calendar
+import time
+
+from .db import primary
+from .history import history
+from .models import Comment, Merge, User, normalize_date
+
+GENERATION_KEY = "review_ladder:generation"
+MODIFIED_KEY = "review_ladder:modified"
+TIMEOUT = getattr(settings, "REVIEW_LADDER_CACHE_TIMEOUT", 24 * 60 * 60)
+
+def get_cache():
+    return caches[getattr(settings, "REVIEW_LADDER_CACHE", "default")]
+
+def _initial_generation():
+    # if the counter got lost (e.g. evicted) we must not start again at a
+    # value we already used, so start with the current time
+    return int(time.time() * 1000)
+
+def generation():
+    cache = get_cache()
+    gen = cache.get(GENERATION_KEY)
+    if gen is None:
+        cache.add(GENERATION_KEY, _initial_generation(), None)
+        gen = cache.get(GENERATION_KEY)
+    return gen
+
+def _bump_generation():
+    cache = get_cache()
+    cache.set(MODIFIED_KEY, time.time(), None)
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.add(GENERATION_KEY, _initial_generation(), None)
+
+def last_modified():
+    # UNIX time of the last write
+    cache = get_cache()
+    modified = cache.get(MODIFIED_KEY)
+    if modified is None:
+        # got lost, so fall back to the newest comment or merge
+        dates = [model.objects.aggregate(date=Max("date"))["date"]
+                 for model in [Comment, Merge]]
+        dates = [calendar.timegm(date.utctimetuple())
+                 for date in dates if date]
+        modified = max(dates) if dates else time.time()
+        if not cache.add(MODIFIED_KEY, modified, None):
+            modified = cache.get(MODIFIED_KEY, modified)
+    return modified
+
+def bump_generation():
+    # invalidates all cached data, once the data written by the current
+    # transaction (if any) is visible to others
+    transaction.on_commit(_bump_generation)
+
+def _window_key(date):
+    if date is None:
+        return "-"
+    return normalize_date(date).isoformat()
+
+# stands for a cached None, which the cache can't tell from a miss
+_NONE = "review_ladder:none"
+
+def cached(name, func, *args):
+    key = "review_ladder:%s:%d:%s" % (name, generation(),
+                                      ":".join(str(arg) for arg in args))
+    cache = get_cache()
+    value = cache.get(key)
+    if value is None:
+        # a replica may not have the writes of this generation yet, which
+        # would then be cached until the next one
+        with primary():
+            value = func()
+        cache.set(key, _NONE if value is None else value, TIMEOUT)
+    elif value == _NONE:
+        value = None
+    return value
+
+def get_ranking(limit=20, since=None, until=None, repo=None, after=None):
+    return cached("ranking",
+                  lambda: User.get_ranking(limit=limit, since=since, until=until,
+                                           repo=repo, after=after),
+                  limit, _window_key(since), _window_key(until), repo or "-",
+                  "%r:%d" % after if after else "-")
+
+def get_rank(user_id, since=None, until=None, repo=None):
+    return cached("rank",
+                  lambda: User.get_rank(user_id, since=since, until=until,
+                                        repo=repo),
+                  user_id, _window_key(since), _window_key(until), repo or "-")
+
+def get_history(since, until, bucket="week", window=None, limit=10, repo=None):
+    return cached("history",
+                  lambda: history(since, until, bucket, window, limit, repo),
+                  since.isoformat(), until.isoformat(), bucket, window, limit,
+                  repo or "-")
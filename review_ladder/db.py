@@ -0,0 +1,80 @@
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+import contextlib
+import threading
+
+# Separates the reads of the ladders from the writes of the importer and the
+# webhook worker. With
+#
+#     DATABASE_ROUTERS = ["review_ladder.db.Router"]
+#
+# the ladder data is read from the REVIEW_LADDER_READ_DATABASE alias (e.g. a
+# replica or a second connection to the same SQLite file) and everything is
+# written to the default database. Code that writes what it read (the
+# importer, the webhook worker) reads from the default database within
+# primary() or an atomic block on it, so it always sees its own writes.
+
+WRITE_DATABASE = DEFAULT_DB_ALIAS
+READ_DATABASE = getattr(settings, "REVIEW_LADDER_READ_DATABASE", "read")
+if READ_DATABASE not in settings.DATABASES:
+    READ_DATABASE = WRITE_DATABASE
+# only the data of the ladders may be a little behind, the bookkeeping of the
+# importer and the webhook queue is always read from the write database
+READ_MODELS = ["comment", "dailyscore", "merge", "pullrequest", "user",
+               "pullrequest_assignees"]
+
+_local = threading.local()
+
+@contextlib.contextmanager
+def primary():
+    # reads in the block (of this thread) go to the write database
+    _local.depth = getattr(_local, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        _local.depth -= 1
+
+def _reading_primary():
+    return (getattr(_local, "depth", 0) > 0) or \
+           connections[WRITE_DATABASE].in_atomic_block
+
+class Router(object):
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != "review_ladder":
+            return None
+        if (model._meta.model_name not in READ_MODELS) or _reading_primary():
+            return WRITE_DATABASE
+        return READ_DATABASE
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != "review_ladder":
+            return None
+        return WRITE_DATABASE
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if "review_ladder" in (obj1._meta.app_label, obj2._meta.app_label):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label != "review_ladder":
+            return None
+        return db == WRITE_DATABASE
+
+def setup_sqlite(sender, connection, **kwargs):
+    # connection_created handler, puts SQLite databases into WAL mode, so
+    # readers don't block the writer and vice versa
+    if connection.vendor != "sqlite":
+        return
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # durable at checkpoints only, which is safe in WAL mode
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=%d" % getattr(
+            settings, "REVIEW_LADDER_SQLITE_BUSY_TIMEOUT", 5000
+        ))
+    if (connection.alias == READ_DATABASE) and \
+       (READ_DATABASE != WRITE_DATABASE):
+        cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
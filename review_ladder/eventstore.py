@@ -0,0 +1,203 @@
+from django.conf import settings
+from django.db import transaction
+
+import gzip
+import heapq
+import logging
+import os
+import socket
+import threading
+import time
+import zlib
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from .cache import bump_generation
+from .models import Comment, DailyScore, Merge, PullRequest, User
+from .writer import BulkWriter
+
+# Everything received from GitHub is appended to gzip compressed JSON lines
+# files in REVIEW_LADDER_EVENT_STORE, so the database can be rebuilt from it
+# without asking GitHub again (e.g. after the scoring rules changed). Each
+# process writes its own segment files, each flush of the buffered records
+# adds a gzip member to it. A record is one of
+#
+# - "pr": the data of an imported PR as returned by github.fetch_pr
+# - "webhook": a processed webhook delivery ({"event": ..., "payload": ...})
+# - "commit": a merge commit fetched while processing a webhook delivery
+
+LOGGER = logging.getLogger(__name__)
+SUFFIX = ".jsonl.gz"
+
+class EventStore(object):
+    def __init__(self, path, segment_size=64 * 1024 * 1024, buffer_size=1000):
+        self.path = path
+        self.segment_size = segment_size
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.segment = None
+        self.lock = threading.Lock()
+
+    def _segment(self):
+        # the segment to append to, a new one once it grew too large
+        if (self.segment is None) or (os.path.getsize(self.segment) >=
+                                      self.segment_size):
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            # segments sort by their creation (and so mostly by their records)
+            self.segment = os.path.join(self.path, "%s-%s-%d%s" % (
+                    time.strftime("%Y%m%dT%H%M%S", time.gmtime()),
+                    socket.gethostname(), os.getpid(), SUFFIX
+                ))
+        return self.segment
+
+    def append(self, kind, repo, data):
+        with self.lock:
+            self.buffer.append(json.dumps({
+                    "time": time.time(),
+                    "kind": kind,
+                    "repo": repo,
+                    "data": data,
+                }, separators=(",", ":"), sort_keys=True))
+            full = len(self.buffer) >= self.buffer_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.buffer:
+                return
+            lines, self.buffer = self.buffer, []
+            # the pid in its name makes this process the only writer
+            with gzip.open(self._segment(), "ab") as segment:
+                segment.write(("\n".join(lines) + "\n").encode("utf-8"))
+
+    def segments(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(os.path.join(self.path, name)
+                      for name in os.listdir(self.path)
+                      if name.endswith(SUFFIX))
+
+    @staticmethod
+    def _read(segment):
+        try:
+            with gzip.open(segment, "rb") as lines:
+                for line in lines:
+                    if line.endswith(b"\n"):
+                        yield json.loads(line.decode("utf-8"))
+        except (EOFError, IOError, zlib.error) as e:
+            # the last member of a segment may be cut off by a crash
+            LOGGER.warning("%s is truncated: %s" % (segment, e))
+
+    def records(self, repos=None):
+        # all records of repos (None for all) in the order they were made
+        def keyed(i, segment):
+            for n, record in enumerate(self._read(segment)):
+                yield (record["time"], i, n), record
+
+        records = heapq.merge(*[keyed(i, segment) for i, segment
+                                in enumerate(self.segments())])
+        for _, record in records:
+            if (repos is None) or (record["repo"] in repos):
+                yield record
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+def get_store():
+    # the configured event store or None if events are not stored
+    global _STORE
+
+    path = getattr(settings, "REVIEW_LADDER_EVENT_STORE", None)
+    if not path:
+        return None
+    with _STORE_LOCK:
+        if (_STORE is None) or (_STORE.path != path):
+            _STORE = EventStore(
+                    path,
+                    segment_size=getattr(
+                            settings, "REVIEW_LADDER_EVENT_STORE_SEGMENT_SIZE",
+                            64 * 1024 * 1024
+                        ),
+                )
+    return _STORE
+
+def record(kind, repo, data):
+    store = get_store()
+    if store is not None:
+        store.append(kind, repo, data)
+
+def flush():
+    store = get_store()
+    if store is not None:
+        store.flush()
+
+def _clear(repos):
+    prs = PullRequest.objects.filter(repo__in=repos)
+    Merge.objects.filter(pr__in=prs).delete()
+    Comment.objects.filter(pr__in=prs).delete()
+    DailyScore.objects.filter(repo__in=repos).delete()
+    prs.delete()
+
+# the keys the data of a record needs to be replayed
+REQUIRED = {
+        "pr": ["pr", "events", "comments", "reviews", "commit"],
+        "webhook": ["event", "payload"],
+        "commit": ["sha", "author"],
+    }
+
+def _valid(record):
+    data = record.get("data")
+    if (record.get("kind") not in REQUIRED) or not isinstance(data, dict):
+        return False
+    return all(key in data for key in REQUIRED[record["kind"]])
+
+def rebuild(repos, store=None, chunk_size=500):
+    # replaces the PRs, comments and merges of repos by those replayed from
+    # the event store, without any request to GitHub. Returns the number of
+    # replayed records.
+    from .views import HANDLERS
+
+    store = store or get_store()
+    if store is None:
+        raise ValueError("REVIEW_LADDER_EVENT_STORE is not configured")
+    replayed = 0
+    with transaction.atomic():
+        _clear(repos)
+        writers = dict((repo, BulkWriter(repo, chunk_size)) for repo in repos)
+        commits = {}
+        for record in store.records(repos):
+            if not _valid(record):
+                LOGGER.warning("Skipping malformed %s record of %s" %
+                               (record.get("kind"), record["repo"]))
+                continue
+            replayed += 1
+            writer = writers[record["repo"]]
+            if record["kind"] == "pr":
+                if writer.add(record["data"]):
+                    writer.flush()
+                continue
+            # webhook deliveries apply to what was imported before
+            writer.flush()
+            if record["kind"] == "commit":
+                commits[record["data"]["sha"]] = record["data"]
+            elif record["data"]["event"] in HANDLERS:
+                try:
+                    # a delivery that cannot be replayed leaves nothing behind
+                    with transaction.atomic():
+                        HANDLERS[record["data"]["event"]](
+                                record["data"]["payload"], commits=commits
+                            )
+                except (KeyError, TypeError, ValueError) as e:
+                    LOGGER.warning("Skipping %s delivery of %s: %s" %
+                                   (record["data"]["event"], record["repo"],
+                                    e))
+        for writer in writers.values():
+            writer.flush()
+        User.reconcile_counters()
+        PullRequest.reconcile_counters()
+        bump_generation()
+    return replayed
@@ -7,19 +7,38 @@
 # Distributed under terms of the MIT license.
 
 from django.conf import settings
-from django.db import transaction
-from django.db.utils import OperationalError
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections, connection, connections
+from django.db.models import Max
+from django.db.utils import IntegrityError, OperationalError
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+from django.utils.six.moves.urllib.parse import urlencode, urlparse
 
+import bisect
+import collections
+import contextlib
 import datetime
 import dateutil.parser
 import logging
+import os
 import requests
 import re
-import schedule
+import socket
 import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+from ipaddress import ip_address, ip_network
 
-from .models import Comment, Merge, PullRequest, User, START_DATE
+from .models import Comment, Lease, SyncState, GITHUB_REPO, GITHUB_REPOS
+from .models import START_DATE, missing_denormalized, normalize_date
+from .cache import bump_generation
+from . import eventstore, metrics
+from .db import primary
+from .writer import BulkWriter
 
 if settings.GITHUB_USER and settings.GITHUB_PW:
     GITHUB_AUTH = requests.auth.HTTPBasicAuth(settings.GITHUB_USER,
@@ -28,134 +47,721 @@ else:
     GITHUB_AUTH = None
 
 LOGGER = logging.getLogger(__name__)
-GITHUB_REPO = "%s/%s" % (settings.GITHUB_REPO_USER, settings.GITHUB_REPO_NAME)
 
-REMAINING = None
-UNTIL = None
+# margin between the start of an import and the watermark for the next one,
+# to compensate for clock skew with GitHub
+SYNC_OVERLAP = datetime.timedelta(minutes=10)
 
-def get(url, *args, **kwargs):
-    global REMAINING, UNTIL
-    if (REMAINING != None) and (UNTIL != None):
-        # rate limit
-        seconds = (UNTIL - datetime.datetime.now()).total_seconds() / REMAINING
-        LOGGER.debug("Rate limitation: sleeping for %f" % seconds)
-        if seconds > 0:
-            time.sleep(seconds)
-    if GITHUB_AUTH:
-        kwargs["auth"] = GITHUB_AUTH
-    res = requests.get(url, *args, **kwargs)
-    LOGGER.debug("Got %s (code: %d%s)" % \
-            (res.url, res.status_code, ", authenticated" if kwargs.get("auth", None) else ""))
-    REMAINING = int(res.headers.get("x-ratelimit-remaining", 5000))
-    UNTIL = datetime.datetime.fromtimestamp(
-            int(res.headers.get("x-ratelimit-reset", time.time() + (60 * 60)))
-        )
-    if (REMAINING == 0) or (res.status_code == 403):
-        seconds = (UNTIL - datetime.datetime.now()).total_seconds()
-        LOGGER.debug("Rate limitation: sleeping for %f" % seconds)
-        if seconds > 0:
+class RateLimiter(object):
+    # token bucket shared by all threads talking to GitHub about one resource
+    # (GitHub's core, search and GraphQL budgets are separate). It is refilled
+    # at a rate that makes the remaining budget reported by GitHub last until
+    # its reset.
+    def __init__(self, burst=10, share=1.):
+        self.burst = burst
+        # the part of the budget this limiter may use, when several processes
+        # share it
+        self.share = share
+        self.tokens = None  # unknown before the first response
+        self.rate = None
+        self.remaining = None   # as last reported by GitHub
+        self.updated = time.time()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if (self.tokens != None) and self.rate:
+            self.tokens = min(self.burst,
+                              self.tokens + ((now - self.updated) * self.rate))
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                if now < self.blocked_until:
+                    seconds = self.blocked_until - now
+                elif self.tokens == None:
+                    return
+                else:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    seconds = (1 - self.tokens) / self.rate if self.rate else 1
+            LOGGER.debug("Rate limitation: sleeping for %f" % seconds)
+            metrics.GITHUB_SLEEP_SECONDS.inc(seconds, "rate_limit")
             time.sleep(seconds)
-        get(url, *args, **kwargs)
-    return res
 
-def github_json_pagination(url, params={}, page=1):
+    def update(self, remaining, reset):
+        with self.lock:
+            now = time.time()
+            self._refill(now)
+            self.remaining = remaining
+            available = remaining * self.share
+            self.rate = available / max(reset - now, 1)
+            if self.tokens == None:
+                self.tokens = min(self.burst, available)
+            else:
+                self.tokens = min(self.tokens, available)
+            if remaining == 0:
+                self.blocked_until = max(self.blocked_until, reset)
+
+    def block(self, until):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, until)
+
+def _endpoint(url):
+    # the path of url without the parts that would blow up the cardinality of
+    # the metrics
+    path = urlparse(url).path
+    path = re.sub(r"^/repos/[^/]+/[^/]+", "/repos/:repo", path)
+    path = re.sub(r"/[0-9a-f]{40}(?=/|$)", "/:sha", path)
+    return re.sub(r"/\d+(?=/|$)", "/:number", path)
+
+def _resource(url):
+    # the rate limit resource a request to url counts against, until GitHub
+    # tells with the response
+    path = urlparse(url).path
+    if "/search/" in path:
+        return "search"
+    elif path.endswith("/graphql"):
+        return "graphql"
+    return "core"
+
+class GithubClient(object):
+    RETRY_STATUS = [500, 502, 503, 504]
+
+    def __init__(self, auth=GITHUB_AUTH, retries=5, backoff=1, burst=10,
+                 timeout=60, pool_size=10):
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.burst = burst
+        self._share = 1.
+        # a rate limiter per resource
+        self.limiters = {}
+        # requests that counted against the rate limit
+        self.spent = 0
+        self.lock = threading.Lock()
+        # keep connections (and their TLS sessions) alive between requests
+        self.session = requests.Session()
+        self.session.auth = auth
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @property
+    def share(self):
+        # the part of the budgets this client may use
+        return self._share
+
+    @share.setter
+    def share(self, share):
+        with self.lock:
+            self._share = share
+            for limiter in self.limiters.values():
+                limiter.share = share
+
+    def limiter(self, resource):
+        with self.lock:
+            if resource not in self.limiters:
+                self.limiters[resource] = RateLimiter(self.burst, self._share)
+            return self.limiters[resource]
+
+    def _retry_after(self, res, attempt):
+        # returns the seconds to wait before retrying res or None if res
+        # should not be retried
+        if res.status_code not in [403, 429] + self.RETRY_STATUS:
+            return None
+        if "Retry-After" in res.headers:
+            return int(res.headers["Retry-After"])
+        if res.headers.get("x-ratelimit-remaining") == "0":
+            return int(res.headers["x-ratelimit-reset"]) - time.time()
+        if res.status_code in self.RETRY_STATUS:
+            return self.backoff * (2 ** attempt)
+        if "rate limit" in res.text.lower():
+            # secondary rate limit without Retry-After: GitHub asks to wait
+            # at least a minute
+            return max(60, self.backoff * (2 ** attempt))
+        return None
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        endpoint = _endpoint(url)
+        for attempt in range(self.retries + 1):
+            self.limiter(_resource(url)).acquire()
+            start = time.time()
+            try:
+                res = self.session.request(method, url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.GITHUB_REQUESTS.inc(1, endpoint, "error")
+                if attempt == self.retries:
+                    raise
+                LOGGER.debug("%s %s failed (%s), retrying" % (method, url, e))
+                metrics.GITHUB_SLEEP_SECONDS.inc(self.backoff * (2 ** attempt),
+                                                 "retry")
+                time.sleep(self.backoff * (2 ** attempt))
+                continue
+            metrics.GITHUB_REQUEST_SECONDS.observe(time.time() - start, endpoint)
+            metrics.GITHUB_REQUESTS.inc(1, endpoint, str(res.status_code))
+            if res.status_code != 304:
+                # answers to conditional requests without changes are free
+                with self.lock:
+                    self.spent += 1
+            LOGGER.debug("%s %s (code: %d%s)" % \
+                    (method, res.url, res.status_code,
+                     ", authenticated" if self.session.auth else ""))
+            resource = res.headers.get("x-ratelimit-resource",
+                                       _resource(url))
+            if "x-ratelimit-remaining" in res.headers:
+                remaining = int(res.headers["x-ratelimit-remaining"])
+                self.limiter(resource).update(
+                        remaining,
+                        int(res.headers.get("x-ratelimit-reset",
+                                            time.time() + (60 * 60)))
+                    )
+                metrics.GITHUB_RATE_LIMIT_REMAINING.set(remaining, resource)
+            seconds = self._retry_after(res, attempt)
+            if (seconds == None) or (attempt == self.retries):
+                return res
+            LOGGER.debug("Rate limitation: retrying %s in %f" % (url, seconds))
+            # hold back all other requests for the resource as well
+            self.limiter(resource).block(time.time() + max(seconds, 0))
+        return res
+
+    def get(self, url, *args, **kwargs):
+        return self.request("GET", url, *args, **kwargs)
+
+    def post(self, url, *args, **kwargs):
+        return self.request("POST", url, *args, **kwargs)
+
+CLIENT = GithubClient(
+        retries=getattr(settings, "GITHUB_RETRIES", 5),
+        burst=getattr(settings, "GITHUB_RATE_LIMIT_BURST", 10),
+        timeout=getattr(settings, "GITHUB_TIMEOUT", 60),
+        pool_size=max(10, getattr(settings, "GITHUB_IMPORT_WORKERS", 1)),
+    )
+
+def get(url, *args, **kwargs):
+    return CLIENT.get(url, *args, **kwargs)
+
+def _http_cache():
+    # the responses get a cache of their own, so they don't push the ladders
+    # out of theirs. None if there is none, so nothing is cached.
+    alias = getattr(settings, "GITHUB_HTTP_CACHE", "github")
+    if alias is None:
+        return None
+    if alias == getattr(settings, "REVIEW_LADDER_CACHE", "default"):
+        raise ImproperlyConfigured("GITHUB_HTTP_CACHE must not be the cache "
+                                   "of the ladders")
+    if alias not in settings.CACHES:
+        if hasattr(settings, "GITHUB_HTTP_CACHE"):
+            raise ImproperlyConfigured("The cache %s in GITHUB_HTTP_CACHE is "
+                                       "not configured" % alias)
+        return None
+    return caches[alias]
+
+def conditional_get(url, params={}):
+    # sends the validators of the last response for the same URL along, so
+    # GitHub can answer with a 304 (which does not count against the rate
+    # limit) if nothing changed. Returns the JSON body and the Link header.
+    key = "review_ladder:http:%s" % sha1(force_bytes(
+            "%s?%s" % (url, urlencode(sorted(params.items())))
+        )).hexdigest()
+    cache = _http_cache()
+    cached = cache.get(key) if cache is not None else None
+    headers = {}
+    if cached:
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+    res = get(url, params=params, headers=headers)
+    if cached and (res.status_code == 304):
+        return cached["body"], cached["link"]
+    body = res.json()
+    etag = res.headers.get("ETag")
+    last_modified = res.headers.get("Last-Modified")
+    if (cache is not None) and (res.status_code == 200) and \
+       (etag or last_modified):
+        cache.set(key, {
+                "etag": etag,
+                "last_modified": last_modified,
+                "link": res.headers.get("Link"),
+                "body": body,
+            }, getattr(settings, "GITHUB_HTTP_CACHE_TIMEOUT",
+                       30 * 24 * 60 * 60))
+    return body, res.headers.get("Link")
+
+def last_page(link, default=1):
+    # the number of the last page in a Link header (the last page itself has
+    # none)
+    match = re.search(r'<[^>]*[?&]page=(\d+)[^>]*>; rel="last"', link or "")
+    return int(match.group(1)) if match else default
+
+def github_json_pagination(url, params={}, page=1, items_key=None):
+    params = dict(params)
     last = 1
     while page <= last:
         params["page"] = page
-        res = get(url, params=params)
-        if "Link" in res.headers:
-            match = re.search(r'page=(\d+)[^>]*>; rel="last"', res.headers['Link'])
-            if match:
-                last = int(match.group(1))
-        for item in res.json():
+        body, link = conditional_get(url, params)
+        last = last_page(link, last)
+        if items_key:
+            body = body.get(items_key, [])
+        for item in body:
             yield item
         page += 1
 
 def github_json_search_pagination(url, params={}, page=1):
-    last = 1
-    while page <= last:
-        params["page"] = page
-        res = get(url, params=params)
-        if "Link" in res.headers:
-            match = re.search(r'page=(\d+)[^>]*>; rel="last"', res.headers['Link'])
-            if match:
-                last = int(match.group(1))
-        for item in res.json().get("items", []):
-            yield item
-        page += 1
+    return github_json_pagination(url, params, page, items_key="items")
 
 def json_hooks():
-    return get('%s/meta' % settings.GITHUB_API).json().get("hooks", [])
+    body, _ = conditional_get('%s/meta' % settings.GITHUB_API)
+    return body.get("hooks", [])
+
+class HookNetworks(object):
+    # The IP ranges GitHub sends webhooks from, as sorted and merged intervals
+    # of integers per IP version. They are refreshed in the background once
+    # they are older than ttl; if GitHub is unreachable the last known ranges
+    # are kept.
+    RETRY = 60
+
+    def __init__(self, ttl=60 * 60):
+        self.ttl = ttl
+        self.intervals = None
+        self.expires = 0
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def parse(cidrs):
+        networks = {4: [], 6: []}
+        for cidr in cidrs:
+            network = ip_network(cidr)
+            networks[network.version].append(
+                    (int(network.network_address),
+                     int(network.broadcast_address))
+                )
+        intervals = {}
+        for version, ranges in networks.items():
+            starts, ends = [], []
+            for start, end in sorted(ranges):
+                if ends and (start <= (ends[-1] + 1)):
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            intervals[version] = (starts, ends)
+        return intervals
 
-def json_prs(page=1):
-    if hasattr(settings, "GITHUB_SINCE"):
+    def refresh(self):
+        try:
+            hooks = json_hooks()
+            if not hooks:
+                raise ValueError("GitHub returned no hook networks")
+            self.intervals = self.parse(hooks)
+            self.expires = time.time() + self.ttl
+        except Exception as e:
+            LOGGER.warning("Unable to get hook networks from GitHub: %s" % e)
+            self.expires = time.time() + self.RETRY
+        finally:
+            self.refreshing = False
+
+    def _check_expiry(self):
+        if self.expires > time.time():
+            return
+        with self.lock:
+            if self.refreshing or (self.expires > time.time()):
+                return
+            self.refreshing = True
+        if self.intervals is None:
+            # nothing to fall back to, so we need to wait
+            self.refresh()
+        else:
+            threading.Thread(target=self.refresh, daemon=True).start()
+
+    def __contains__(self, address):
+        self._check_expiry()
+        intervals = self.intervals
+        if intervals is None:
+            return False
+        address = ip_address(address)
+        starts, ends = intervals[address.version]
+        i = bisect.bisect_right(starts, int(address)) - 1
+        return (i >= 0) and (int(address) <= ends[i])
+
+HOOK_NETWORKS = HookNetworks(getattr(settings, "GITHUB_HOOKS_TTL", 60 * 60))
+
+def json_updated_prs(since, repo=GITHUB_REPO):
+    # PRs sorted by their last update, until the first one older than since
+    for json_pr in github_json_pagination(
+                '%s/repos/%s/pulls' % (settings.GITHUB_API, repo),
+                {"state": "all", "sort": "updated", "direction": "desc"}
+            ):
+        # the watermark is naive without USE_TZ, GitHub's dates never are
+        if normalize_date(dateutil.parser.parse(json_pr["updated_at"])) < \
+           normalize_date(since):
+            return
+        yield json_pr
+
+def json_prs(page=1, since=None, repo=GITHUB_REPO):
+    if since:
+        return json_updated_prs(since, repo)
+    elif hasattr(settings, "GITHUB_SINCE"):
         since_str = START_DATE.isoformat() # START_DATE == settings.GITHUB_SINCE as datetime
         return github_json_search_pagination(
                 '%s/search/issues' % (settings.GITHUB_API),
                 {
-                    "q": "repo:%s type:pr updated:>=%s" % (GITHUB_REPO, since_str),
+                    "q": "repo:%s type:pr updated:>=%s" % (repo, since_str),
                     "sort": "updated",
                 },
                 page=page
             )
     else:
         return github_json_pagination(
-                '%s/repos/%s/pulls' % (settings.GITHUB_API, GITHUB_REPO),
+                '%s/repos/%s/pulls' % (settings.GITHUB_API, repo),
                 {"state": "all"},
                 page=page
             )
 
-def json_issue_events(issue, page=1):
+def json_pr_page(page, per_page=100, repo=GITHUB_REPO):
+    # a page of all PRs, oldest first, so the pages stay the same while new
+    # PRs are opened. Returns the PRs and the number of pages.
+    body, link = conditional_get(
+            '%s/repos/%s/pulls' % (settings.GITHUB_API, repo),
+            {"state": "all", "sort": "created", "direction": "asc",
+             "per_page": per_page, "page": page}
+        )
+    return body, last_page(link, page)
+
+def json_pull(number, repo=GITHUB_REPO):
+    body, _ = conditional_get('%s/repos/%s/pulls/%d' % (settings.GITHUB_API,
+                                                       repo, number))
+    return body
+
+def json_issue_events(issue, page=1, repo=GITHUB_REPO):
     return github_json_pagination(
-            '%s/repos/%s/issues/%d/events' % (settings.GITHUB_API, GITHUB_REPO, issue),
+            '%s/repos/%s/issues/%d/events' % (settings.GITHUB_API, repo, issue),
             page=page
         )
 
-def json_comments(pr, page=1):
+def json_comments(pr, page=1, repo=GITHUB_REPO):
     return github_json_pagination(
-            '%s/repos/%s/pulls/%d/comments' % (settings.GITHUB_API, GITHUB_REPO, pr),
+            '%s/repos/%s/pulls/%d/comments' % (settings.GITHUB_API, repo, pr),
             page=page
         )
 
-def json_reviews(pr, page=1):
+def json_reviews(pr, page=1, repo=GITHUB_REPO):
     return github_json_pagination(
-            '%s/repos/%s/pulls/%d/reviews' % (settings.GITHUB_API, GITHUB_REPO, pr),
+            '%s/repos/%s/pulls/%d/reviews' % (settings.GITHUB_API, repo, pr),
             page=page
         )
 
-def json_commit(sha):
-    res = get('%s/repos/%s/commits/%s' % (settings.GITHUB_API, GITHUB_REPO, sha))
-    return res.json()
+def json_commit(sha, repo=GITHUB_REPO):
+    body, _ = conditional_get('%s/repos/%s/commits/%s' % (settings.GITHUB_API,
+                                                         repo, sha))
+    return body
 
-def import_models(pr_page=1):
-    for json_pr in json_prs(pr_page):
-        try:
-            pr, _ = PullRequest.from_github_json(json_pr, json_issue_events(
-                    json_pr["number"]
-                ))
-            with transaction.atomic():
-                for json_comment in json_comments(pr.number):
-                    Comment.from_github_json(json_comment, pr)
-                for json_review in json_reviews(pr.number):
-                    Comment.from_github_review_json(json_review, pr)
-            if ("merged_at" not in json_pr) and json_pr["state"] == "closed":
-                # PR data came through search => we need to get the actual object
-                res = get('%s/repos/%s/pulls/%d' % (settings.GITHUB_API, GITHUB_REPO, pr.number))
-                json_pr = res.json()
-            if json_pr.get("merged_at", None):
-                c = json_commit(json_pr["merge_commit_sha"])
-                if "author" not in c:
-                    # HTTP error returned an empty object
-                    continue
-                Merge.from_github_json(c, pr)
-        except OperationalError as e:
-            continue    # skip for now and try in next round
-
-import_schedule = schedule.every().day.do(import_models)
+def fetch_pr(json_pr, repo=GITHUB_REPO):
+    # fetches everything needed to import a PR, without touching the database
+    number = json_pr["number"]
+    data = {
+            "pr": json_pr,
+            "events": list(json_issue_events(number, repo=repo)),
+            "comments": list(json_comments(number, repo=repo)),
+            "reviews": list(json_reviews(number, repo=repo)),
+            "commit": None,
+        }
+    if ("merged_at" not in json_pr) and json_pr["state"] == "closed":
+        # PR data came through search => we need to get the actual object
+        json_pr = json_pull(number, repo)
+    if json_pr.get("merged_at", None):
+        c = json_commit(json_pr["merge_commit_sha"], repo)
+        # HTTP error returns an empty object
+        if c.get("author"):
+            data["commit"] = c
+    return data
+
+def _fetch_pr_in_worker(json_pr, repo):
+    try:
+        return fetch_pr(json_pr, repo)
+    finally:
+        # a database backed cache opens connections in the worker threads,
+        # which are not closed by anyone else
+        connections.close_all()
+
+def fetch_prs(json_prs, workers=1, repo=GITHUB_REPO):
+    if workers <= 1:
+        for json_pr in json_prs:
+            yield fetch_pr(json_pr, repo)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # keep only a bounded number of PRs in flight, but yield them in order
+        pending = collections.deque()
+        for json_pr in json_prs:
+            pending.append(executor.submit(_fetch_pr_in_worker, json_pr,
+                                           repo))
+            if len(pending) >= (2 * workers):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def _flush(writer, watermark):
+    prs = writer.pending
+    try:
+        writer.flush()
+    except (IntegrityError, OperationalError):
+        # skip for now and try in next round
+        LOGGER.exception("Writing %d PRs failed, retrying them next round" %
+                         len(prs))
+        for data in prs:
+            watermark = min(watermark,
+                            normalize_date(dateutil.parser.parse(
+                                    data["pr"]["updated_at"]
+                                )))
+    finally:
+        eventstore.flush()
+        bump_generation()
+    return watermark
+
+def _clients():
+    # the clients whose requests count against the budget of an import
+    if getattr(settings, "GITHUB_IMPORT_BACKEND", "rest") == "graphql":
+        from . import graphql
+
+        return [CLIENT, graphql.CLIENT]
+    return [CLIENT]
+
+def import_models(pr_page=1, workers=None, incremental=True, repo=GITHUB_REPO,
+                  budget=None, stop=None):
+    # PRs are fetched by a pool of workers (if configured) or in batches via
+    # GraphQL, but only written to the database from this thread. Stops
+    # early once about budget requests were spent or right away (without
+    # writing anything else) once the event stop is set, returns if the
+    # import is complete.
+    if workers is None:
+        workers = getattr(settings, "GITHUB_IMPORT_WORKERS", 1)
+    started = timezone.now()
+    since = None
+    if incremental:
+        # only look at PRs updated since the last successful import
+        since = SyncState.watermark_for(repo)
+    watermark = started - SYNC_OVERLAP
+    if getattr(settings, "GITHUB_IMPORT_BACKEND", "rest") == "graphql":
+        from . import graphql
+
+        if (since is None) and hasattr(settings, "GITHUB_SINCE"):
+            since = START_DATE
+        prs = graphql.fetch_prs(since, repo=repo)
+    else:
+        prs = fetch_prs(json_prs(pr_page, since, repo), workers, repo)
+    clients = _clients()
+    spent = sum(client.spent for client in clients)
+    start = time.time()
+    imported = 0
+    complete = True
+    try:
+        writer = BulkWriter(repo)
+        for data in prs:
+            if (stop is not None) and stop.is_set():
+                LOGGER.warning("Stopping the import of %s" % repo)
+                complete = False
+                break
+            imported += 1
+            eventstore.record("pr", repo, data)
+            if writer.add(data):
+                watermark = _flush(writer, watermark)
+            if (budget is not None) and \
+               ((sum(client.spent for client in clients) - spent) >= budget):
+                complete = False
+                break
+        if (stop is None) or not stop.is_set():
+            watermark = _flush(writer, watermark)
+        if complete and (pr_page == 1):
+            SyncState.objects.update_or_create(repo=repo,
+                                               defaults={"watermark": watermark})
+    except Exception:
+        metrics.IMPORTS.inc(1, "error")
+        raise
+    else:
+        metrics.IMPORTS.inc(1, "success" if complete else "incomplete")
+    finally:
+        metrics.IMPORT_SECONDS.observe(time.time() - start)
+        metrics.IMPORT_PRS.observe(imported)
+    return complete
+
+class ImportScheduler(object):
+    # Shares the request budget of one API token between the repositories.
+    # The due repositories are imported one after another, the most recently
+    # active first, each with a share of the remaining budget weighted by its
+    # activity, so what one leaves unused goes to those after it. An import
+    # that ran out of budget starts over in the next round, mostly with free
+    # conditional requests for what it already imported. Without a configured
+    # budget (or with a single repository) every import runs to completion,
+    # slowed down by the rate limiter.
+    # the weight of a repository halves after a week without comments, but
+    # does not get below MIN_WEIGHT, so inactive repositories still get some
+    ACTIVITY_DAYS = 7.
+    MIN_WEIGHT = .1
+
+    def __init__(self, budget=None, stop=None):
+        if budget is None:
+            budget = getattr(settings, "GITHUB_IMPORT_BUDGET", None)
+        self.budget = budget
+        # an event that ends the round when set
+        self.stop = stop
+
+    def weights(self, repos):
+        latest = dict(Comment.objects.filter(pr__repo__in=repos)
+                                     .order_by()
+                                     .values_list("pr__repo")
+                                     .annotate(Max("date")))
+        now = timezone.now()
+        weights = {}
+        for repo in repos:
+            if latest.get(repo) is None:
+                weights[repo] = self.MIN_WEIGHT
+                continue
+            days = max((now - normalize_date(latest[repo])).total_seconds(),
+                       0) / (24 * 60 * 60)
+            weights[repo] = max(1. / (1 + (days / self.ACTIVITY_DAYS)),
+                                self.MIN_WEIGHT)
+        return weights
+
+    def run(self, repos):
+        # imports repos, returns the ones that could not be imported
+        # completely
+        weights = self.weights(repos)
+        # sorted() is stable, so equally active ones stay in configured order
+        repos = sorted(repos, key=lambda repo: -weights[repo])
+        # a single repository has nothing to share, capping it would only
+        # make it start over again and again
+        budget = self.budget if len(repos) > 1 else None
+        clients = _clients()
+        incomplete = []
+        for i, repo in enumerate(repos):
+            if (self.stop is not None) and self.stop.is_set():
+                incomplete.extend(repos[i:])
+                break
+            share = None
+            if budget is not None:
+                share = max(budget, 0) * weights[repo] / \
+                        sum(weights[other] for other in repos[i:])
+            spent = sum(client.spent for client in clients)
+            try:
+                if not import_models(repo=repo, budget=share, stop=self.stop):
+                    LOGGER.info("Budget of %s used up, continuing next round"
+                                % repo)
+                    incomplete.append(repo)
+            except Exception:
+                LOGGER.exception("Import of %s failed" % repo)
+                incomplete.append(repo)
+            if budget is not None:
+                budget -= sum(client.spent for client in clients) - spent
+        return incomplete
+
+IMPORTER_LEASE = "importer"
 
 class GithubImporter(threading.Thread):
+    # Imports the due repositories every interval seconds, but only in the
+    # process holding the importer lease, so only one process of a deployment
+    # imports at a time. If that process dies, another one takes over once
+    # the lease expired.
+    def __init__(self, interval=None, lease=None):
+        super(GithubImporter, self).__init__()
+        if interval is None:
+            interval = getattr(settings, "GITHUB_IMPORT_INTERVAL", 60 * 60)
+        if lease is None:
+            lease = getattr(settings, "REVIEW_LADDER_LEASE_DURATION", 5 * 60)
+        self.interval = interval
+        self.lease = lease
+        self.holder = "%s:%d:%s" % (socket.gethostname(), os.getpid(),
+                                    uuid.uuid4().hex[:8])
+        self.last_run = None
+        # set once another process took over the lease during an import
+        self.lost = threading.Event()
+        # if the rollup and the counters were checked to be filled
+        self.checked = False
+
+    def _due(self, repo):
+        if (self.last_run != None) and \
+           ((time.time() - self.last_run) < self.interval):
+            return False
+        # the watermark is where the last successful import started
+        watermark = SyncState.watermark_for(repo)
+        return (watermark is None) or \
+               ((timezone.now() - watermark - SYNC_OVERLAP) >=
+                datetime.timedelta(seconds=self.interval))
+
+    def _renew(self, stop):
+        renewed = time.time()
+        try:
+            while not stop.wait(self.lease / 3.):
+                try:
+                    if Lease.acquire(IMPORTER_LEASE, self.holder, self.lease):
+                        renewed = time.time()
+                        continue
+                    LOGGER.warning("%s lost the importer lease" % self.holder)
+                    self.lost.set()
+                except (IntegrityError, OperationalError) as e:
+                    LOGGER.warning("Unable to renew the importer lease: %s" % e)
+                    if (time.time() - renewed) >= self.lease:
+                        # another process may have taken over by now
+                        self.lost.set()
+        finally:
+            connection.close()
+
+    @contextlib.contextmanager
+    def _heartbeat(self):
+        # keeps renewing the lease while the block runs
+        stop = threading.Event()
+        renewer = threading.Thread(target=self._renew, args=(stop,))
+        renewer.daemon = True
+        renewer.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            renewer.join()
+
+    def run_once(self, force=False):
+        # imports if this process is the leader and an import is due (or
+        # forced), returns if it imported
+        close_old_connections()
+        if not Lease.acquire(IMPORTER_LEASE, self.holder, self.lease):
+            return False
+        if not self.checked:
+            # filling them here would race with the webhook worker
+            with primary():
+                if missing_denormalized():
+                    LOGGER.warning("The daily score rollup or the counters "
+                                   "are not filled, run the "
+                                   "rebuild_daily_scores and "
+                                   "reconcile_counters commands")
+            self.checked = True
+        repos = [repo for repo in GITHUB_REPOS if force or self._due(repo)]
+        if not repos:
+            return False
+        self.last_run = time.time()
+        from . import snapshots
+
+        self.lost.clear()
+        with self._heartbeat(), primary():
+            ImportScheduler(stop=self.lost).run(repos)
+            if not self.lost.is_set():
+                snapshots.update()
+        return True
+
+    def release(self):
+        Lease.release(IMPORTER_LEASE, self.holder)
+
     def run(self):
         while True:
-            import_schedule.run()
-            schedule.run_pending()
-            time.sleep(3600)
+            try:
+                self.run_once()
+            except Exception:
+                LOGGER.exception("Import failed")
+            # also renews the lease of the leader
+            time.sleep(self.lease / 3.)
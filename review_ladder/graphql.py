@@ -0,0 +1,215 @@
+from django.conf import settings
+
+import dateutil.parser
+import logging
+
+from .github import GithubClient, GITHUB_AUTH, fetch_pr, json_pull
+from .models import GITHUB_REPO, normalize_date
+
+LOGGER = logging.getLogger(__name__)
+GITHUB_GRAPHQL_API = getattr(settings, "GITHUB_GRAPHQL_API",
+                             "%s/graphql" % settings.GITHUB_API)
+# GraphQL queries have their own rate limit, so they get their own client
+CLIENT = GithubClient(
+        auth=GITHUB_AUTH,
+        retries=getattr(settings, "GITHUB_RETRIES", 5),
+        burst=getattr(settings, "GITHUB_RATE_LIMIT_BURST", 10),
+        timeout=getattr(settings, "GITHUB_TIMEOUT", 60),
+    )
+
+# Deleted accounts are null in GraphQL, while the REST API reports them as
+# this user
+GHOST = {
+        "id": 10137,
+        "login": "ghost",
+        "avatar_url": "https://avatars.githubusercontent.com/u/10137?v=4",
+    }
+
+PRS_QUERY = """
+fragment user on Actor {
+  login
+  avatarUrl
+  ... on User { databaseId }
+  ... on Bot { databaseId }
+  ... on Mannequin { databaseId }
+  ... on Organization { databaseId }
+}
+
+query($owner: String!, $name: String!, $count: Int!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(first: $count, after: $cursor,
+                 orderBy: {field: UPDATED_AT, direction: DESC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number
+        state
+        updatedAt
+        mergedAt
+        author { ...user }
+        mergeCommit {
+          oid
+          author { date user { ...user } }
+        }
+        timelineItems(first: %(nested)d,
+                      itemTypes: [ASSIGNED_EVENT, UNASSIGNED_EVENT,
+                                  REVIEW_REQUESTED_EVENT,
+                                  REVIEW_REQUEST_REMOVED_EVENT]) {
+          pageInfo { hasNextPage }
+          nodes {
+            __typename
+            ... on AssignedEvent { assignee { ...user } }
+            ... on UnassignedEvent { assignee { ...user } }
+            ... on ReviewRequestedEvent { requestedReviewer { ...user } }
+            ... on ReviewRequestRemovedEvent { requestedReviewer { ...user } }
+          }
+        }
+        reviews(first: %(nested)d) {
+          pageInfo { hasNextPage }
+          nodes {
+            databaseId
+            state
+            submittedAt
+            author { ...user }
+            comments(first: %(nested)d) {
+              pageInfo { hasNextPage }
+              nodes { databaseId createdAt author { ...user } }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+EVENTS = {
+        "AssignedEvent": ("assigned", "assignee", "assignee"),
+        "UnassignedEvent": ("unassigned", "assignee", "assignee"),
+        "ReviewRequestedEvent": ("review_requested", "requestedReviewer",
+                                 "requested_reviewer"),
+        "ReviewRequestRemovedEvent": ("review_request_removed",
+                                      "requestedReviewer",
+                                      "requested_reviewer"),
+    }
+
+class GraphQLError(Exception):
+    pass
+
+def query(query, **variables):
+    res = CLIENT.post(GITHUB_GRAPHQL_API,
+                      json={"query": query, "variables": variables})
+    res.raise_for_status()
+    body = res.json()
+    if body.get("errors") and not body.get("data"):
+        raise GraphQLError("; ".join(error.get("message", "")
+                                     for error in body["errors"]))
+    return body["data"]
+
+def json_user(actor):
+    # None for what is no account, e.g. a team a review was requested from
+    if actor is None:
+        return GHOST
+    if actor.get("databaseId") is None:
+        return None
+    return {
+            "id": actor["databaseId"],
+            "login": actor["login"],
+            "avatar_url": actor["avatarUrl"],
+        }
+
+def _truncated(node):
+    if node["timelineItems"]["pageInfo"]["hasNextPage"] or \
+       node["reviews"]["pageInfo"]["hasNextPage"]:
+        return True
+    return any(review["comments"]["pageInfo"]["hasNextPage"]
+               for review in node["reviews"]["nodes"])
+
+def pr_data(node, repo=GITHUB_REPO):
+    # adapts a pull request node to what github.fetch_pr returns
+    json_pr = {
+            "number": node["number"],
+            "user": json_user(node["author"]),
+            "state": "open" if node["state"] == "OPEN" else "closed",
+            "updated_at": node["updatedAt"],
+            "merged_at": node["mergedAt"],
+            "merge_commit_sha": None,
+        }
+    if node["mergeCommit"]:
+        json_pr["merge_commit_sha"] = node["mergeCommit"]["oid"]
+    authors = [node["author"]]
+    for review in node["reviews"]["nodes"]:
+        authors.append(review["author"])
+        authors.extend(comment["author"]
+                       for comment in review["comments"]["nodes"])
+    if _truncated(node) or any((author is not None) and
+                               (json_user(author) is None)
+                               for author in authors):
+        # more nested data than fit into the query or authors we can't tell
+        # apart, so fall back to REST for this PR
+        LOGGER.debug("#%d can't be imported with GraphQL, using REST" %
+                     node["number"])
+        if json_pr["user"] is None:
+            json_pr = json_pull(node["number"], repo)
+        return fetch_pr(json_pr, repo)
+    data = {
+            "pr": json_pr,
+            "events": [],
+            "comments": [],
+            "reviews": [],
+            "commit": None,
+        }
+    for item in node["timelineItems"]["nodes"]:
+        if item["__typename"] in EVENTS:
+            event, field, json_field = EVENTS[item["__typename"]]
+            # like the REST importer, skip requests for teams
+            if json_user(item[field]) is None:
+                continue
+            data["events"].append({
+                    "event": event,
+                    json_field: json_user(item[field]),
+                })
+    for review in node["reviews"]["nodes"]:
+        data["reviews"].append({
+                "id": review["databaseId"],
+                "user": json_user(review["author"]),
+                "state": review["state"],
+                "submitted_at": review["submittedAt"],
+            })
+        for comment in review["comments"]["nodes"]:
+            data["comments"].append({
+                    "id": comment["databaseId"],
+                    "user": json_user(comment["author"]),
+                    "created_at": comment["createdAt"],
+                })
+    merge_commit = node["mergeCommit"]
+    if node["mergedAt"] and merge_commit and merge_commit["author"]["user"]:
+        data["commit"] = {
+                "sha": merge_commit["oid"],
+                "author": json_user(merge_commit["author"]["user"]),
+                "commit": {"author": {"date": merge_commit["author"]["date"]}},
+            }
+    return data
+
+def fetch_prs(since=None, batch=None, nested=None, repo=GITHUB_REPO):
+    # yields the data of all PRs of repo (updated since since), fetching up to
+    # batch PRs with all their reviews, comments and events per query
+    if batch is None:
+        batch = getattr(settings, "GITHUB_GRAPHQL_BATCH", 50)
+    if nested is None:
+        nested = getattr(settings, "GITHUB_GRAPHQL_NESTED", 50)
+    prs_query = PRS_QUERY % {"nested": nested}
+    owner, name = repo.split("/", 1)
+    cursor = None
+    while True:
+        data = query(prs_query, owner=owner, name=name, count=min(batch, 100),
+                     cursor=cursor)
+        prs = data["repository"]["pullRequests"]
+        for node in prs["nodes"]:
+            if since and (normalize_date(dateutil.parser.parse(
+                                  node["updatedAt"]
+                              )) < normalize_date(since)):
+                return
+            yield pr_data(node, repo)
+        if not prs["pageInfo"]["hasNextPage"]:
+            return
+        cursor = prs["pageInfo"]["endCursor"]
@@ -0,0 +1,120 @@
+from django.db.models import Sum
+
+import bisect
+import collections
+import datetime
+
+from .models import Comment, DailyScore, User
+
+# The history of a ladder: scores and ranks of the maintainers per day, week
+# or month, optionally over a rolling window of days ending with each bucket.
+# All buckets are computed from one grouped query over the DailyScore rollup
+# with prefix sums per user, instead of a ranking per bucket.
+
+BUCKETS = ["day", "week", "month"]
+STATS = ["approvals", "change_requests", "comments", "merges"]
+ONE_DAY = datetime.timedelta(days=1)
+
+def bucket_start(day, bucket):
+    if bucket == "week":
+        return day - datetime.timedelta(days=day.weekday())
+    elif bucket == "month":
+        return day.replace(day=1)
+    return day
+
+def next_bucket(start, bucket):
+    if bucket == "week":
+        return start + datetime.timedelta(days=7)
+    elif bucket == "month":
+        return (start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    return start + ONE_DAY
+
+def previous_buckets(until, bucket, count):
+    # the start of the bucket count - 1 buckets before the one of until
+    start = bucket_start(until, bucket)
+    for _ in range(count - 1):
+        start = bucket_start(start - ONE_DAY, bucket)
+    return start
+
+def bucket_ranges(since, until, bucket):
+    # (first day, last day) of each bucket from since to until (inclusive)
+    ranges = []
+    start = bucket_start(since, bucket)
+    while start <= until:
+        end = next_bucket(start, bucket)
+        ranges.append((start, min(end - ONE_DAY, until)))
+        start = end
+    return ranges
+
+def _score(counts):
+    # summed up in the same order as in User.ranked() to get the same floating
+    # point results
+    return (counts[0] * Comment.ACK) + (counts[1] * Comment.CRQ) + \
+           (counts[2] * Comment.COM) + (counts[3] * Comment.MRG)
+
+class _Prefix(object):
+    # cumulative stats of a user over the days with activity
+    def __init__(self):
+        self.days = []
+        self.sums = [(0, 0, 0, 0)]
+
+    def add(self, day, counts):
+        self.days.append(day)
+        self.sums.append(tuple(a + b for a, b in zip(self.sums[-1], counts)))
+
+    def until(self, day):
+        return self.sums[bisect.bisect_right(self.days, day)]
+
+    def between(self, first, last):
+        return tuple(b - a for a, b in zip(self.until(first - ONE_DAY),
+                                           self.until(last)))
+
+def history(since, until, bucket="week", window=None, limit=10, repo=None):
+    # scores and ranks per bucket of the limit maintainers with the highest
+    # score from since to until (dates, inclusive). With window (in days) the
+    # score of a bucket is the one of the window days up to its end.
+    ranges = bucket_ranges(since, until, bucket)
+    if not ranges:
+        raise ValueError("since must not be after until")
+    first = ranges[0][0]
+    if window:
+        first = min(first, ranges[0][1] - datetime.timedelta(days=window - 1))
+    rows = DailyScore.objects.filter(day__gte=first, day__lte=ranges[-1][1])
+    if repo is not None:
+        rows = rows.filter(repo=repo)
+    prefixes = collections.defaultdict(_Prefix)
+    for row in (rows.order_by("user", "day")
+                    .values_list("user", "day")
+                    .annotate(*[Sum(stat) for stat in STATS])):
+        prefixes[row[0]].add(row[1], row[2:])
+    scores = {}
+    for user, prefix in prefixes.items():
+        scores[user] = [
+                _score(prefix.between(
+                        (end - datetime.timedelta(days=window - 1))
+                        if window else start, end
+                    ))
+                for start, end in ranges
+            ]
+    ranks = dict((user, [None] * len(ranges)) for user in scores)
+    for i in range(len(ranges)):
+        ranked = sorted((user for user in scores if scores[user][i] > 0),
+                        key=lambda user: (-scores[user][i], user))
+        for rank, user in enumerate(ranked, 1):
+            ranks[user][i] = rank
+    top = sorted((user for user in scores if any(scores[user])),
+                 key=lambda user: (-sum(scores[user]), user))[:limit]
+    users = User.objects.in_bulk(top)
+    return {
+            "bucket": bucket,
+            "window": window,
+            "since": ranges[0][0].isoformat(),
+            "until": ranges[-1][1].isoformat(),
+            "buckets": [start.isoformat() for start, _ in ranges],
+            "maintainers": [{
+                    "name": users[user].name,
+                    "avatar_url": users[user].avatar_url,
+                    "scores": scores[user],
+                    "ranks": ranks[user],
+                } for user in top],
+        }
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from review_ladder.backfill import backfill, retry_failed
+from review_ladder.db import primary
+from review_ladder.models import BackfillShard, GITHUB_REPO, GITHUB_REPOS
+
+class Command(BaseCommand):
+    help = "Imports all PRs from GitHub with several worker processes. " \
+           "An interrupted backfill resumes when run again."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4,
+                            help="Number of worker processes")
+        parser.add_argument("--shards", type=int,
+                            help="Number of shards to split the PRs into "
+                                 "(default: number of workers)")
+        parser.add_argument("--restart", action="store_true",
+                            help="Discard the progress of an interrupted "
+                                 "backfill")
+        parser.add_argument("--retry-failed", action="store_true",
+                            help="Only import the PRs that failed before")
+        parser.add_argument("--repo", default=GITHUB_REPO,
+                            help="Repository to import (default: %s)" %
+                                 GITHUB_REPO)
+
+    def report(self, progress):
+        if self.verbosity > 0:
+            self.stdout.write(str(progress))
+
+    def handle(self, *args, **options):
+        self.verbosity = options["verbosity"]
+        repo = options["repo"]
+        if options["workers"] < 1:
+            raise CommandError("--workers must be at least 1")
+        if repo not in GITHUB_REPOS:
+            raise CommandError("%s is not in GITHUB_REPOS" % repo)
+        with primary():
+            if options["retry_failed"]:
+                progress = retry_failed(repo, report=self.report)
+            else:
+                if options["restart"]:
+                    BackfillShard.objects.filter(repo=repo).delete()
+                try:
+                    progress = backfill(options["workers"], options["shards"],
+                                        repo, report=self.report)
+                except RuntimeError as e:
+                    raise CommandError(str(e))
+        self.stdout.write("Imported %d PRs in %.1f s (%.1f PRs/s), "
+                          "%d failed" % (progress.prs, progress.seconds,
+                                         progress.prs_per_second,
+                                         progress.failed))
+        if progress.failed:
+            self.stdout.write("Retry the failed PRs with --retry-failed")
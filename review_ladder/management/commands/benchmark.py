@@ -0,0 +1,113 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.utils import setup_databases, setup_test_environment
+from django.test.utils import teardown_databases, teardown_test_environment
+from django.utils import timezone
+
+import json
+import platform
+
+from review_ladder.bench.runner import BENCHMARKS, isolated_caches
+from review_ladder.db import READ_DATABASE, WRITE_DATABASE
+
+def _ints(value):
+    return [int(v) for v in value.split(",")]
+
+def _windows(value):
+    return [None if v == "all" else int(v) for v in value.split(",")]
+
+class Command(BaseCommand):
+    help = "Benchmarks ranking, import and webhooks on synthetic data in a " \
+           "test database and prints the results as JSON lines"
+
+    def add_arguments(self, parser):
+        parser.add_argument("benchmarks", nargs="*",
+                            help="Benchmarks to run (%s, default: all)" %
+                                 ", ".join(sorted(BENCHMARKS)))
+        parser.add_argument("--output", help="Append the results to this file")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--users", type=int, default=50)
+        parser.add_argument("--prs", type=int, default=1000,
+                            help="Number of PRs for import and webhook")
+        parser.add_argument("--comments", type=float, default=5,
+                            help="Average number of comments per PR")
+        parser.add_argument("--reviews", type=float, default=2,
+                            help="Average number of reviews per PR")
+        parser.add_argument("--assignments", type=float, default=1,
+                            help="Average number of assignments per PR")
+        parser.add_argument("--merged", type=float, default=.6,
+                            help="Share of merged PRs")
+        parser.add_argument("--days", type=int, default=3 * 365,
+                            help="Length of the PR history in days")
+        parser.add_argument("--sizes", type=_ints, default=[1000, 10000],
+                            help="Comma-separated numbers of PRs for ranking")
+        parser.add_argument("--windows", type=_windows,
+                            default=[7, 30, 365, None],
+                            help="Comma-separated ranking windows in days "
+                                 "('all' for the whole history)")
+        parser.add_argument("--repeat", type=int, default=10,
+                            help="Number of rankings per window")
+        parser.add_argument("--backend", choices=["rest", "graphql"],
+                            default="rest")
+        parser.add_argument("--workers", type=int, default=1)
+        parser.add_argument("--latency", type=float, default=0,
+                            help="Seconds added to each fake GitHub response")
+        parser.add_argument("--touched", type=int, default=10,
+                            help="PRs updated before the incremental import")
+        parser.add_argument("--events", type=int, default=1000,
+                            help="Number of webhook deliveries")
+        parser.add_argument("--keepdb", action="store_true",
+                            help="Keep the test database between runs")
+
+    def _arguments(self, benchmark, options):
+        kwargs = dict((name, options[name]) for name in
+                      ["seed", "users", "comments", "reviews", "assignments",
+                       "merged", "days"])
+        if benchmark == "ranking":
+            kwargs.update(sizes=options["sizes"], windows=options["windows"],
+                          repeat=options["repeat"])
+        elif benchmark == "import":
+            kwargs.update(prs=options["prs"], backend=options["backend"],
+                          workers=options["workers"],
+                          latency=options["latency"],
+                          touched=options["touched"])
+        elif benchmark == "webhook":
+            kwargs.update(prs=options["prs"], events=options["events"])
+        return kwargs
+
+    def handle(self, *args, **options):
+        benchmarks = options["benchmarks"] or sorted(BENCHMARKS)
+        for benchmark in benchmarks:
+            if benchmark not in BENCHMARKS:
+                raise CommandError("Unknown benchmark %s" % benchmark)
+        output = self.stdout
+        if options["output"]:
+            output = open(options["output"], "a")
+        run = {
+                "started": timezone.now().isoformat(),
+                "python": platform.python_version(),
+                "database": connection.vendor,
+            }
+        setup_test_environment()
+        if READ_DATABASE != WRITE_DATABASE:
+            # the ladders are read from the generated data as well
+            connections[READ_DATABASE].settings_dict.setdefault(
+                    "TEST", {}
+                ).setdefault("MIRROR", WRITE_DATABASE)
+        # a test database for every alias, so no benchmark touches real data
+        old_config = setup_databases(verbosity=0, interactive=False,
+                                     keepdb=options["keepdb"])
+        try:
+            with isolated_caches():
+                for benchmark in benchmarks:
+                    kwargs = self._arguments(benchmark, options)
+                    for result in BENCHMARKS[benchmark](**kwargs):
+                        result["run"] = run
+                        output.write("%s\n" % json.dumps(result, sort_keys=True))
+                        output.flush()
+        finally:
+            teardown_databases(old_config, verbosity=0,
+                               keepdb=options["keepdb"])
+            teardown_test_environment()
+            if output is not self.stdout:
+                output.close()
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from review_ladder.webhooks import WebhookWorker, process_queue
+
+class Command(BaseCommand):
+    help = "Processes the queued webhook deliveries from GitHub"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100,
+                            help="Number of deliveries processed at once")
+        parser.add_argument("--interval", type=float, default=1,
+                            help="Seconds to wait when the queue is empty")
+        parser.add_argument("--once", action="store_true",
+                            help="Only drain the queue once and exit")
+
+    def handle(self, *args, **options):
+        if options["once"]:
+            processed = 0
+            while True:
+                batch = process_queue(options["batch_size"])
+                if not batch:
+                    break
+                processed += batch
+            self.stdout.write("Processed %d webhook deliveries" % processed)
+        else:
+            WebhookWorker(options["batch_size"], options["interval"]).run()
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from review_ladder.snapshots import get_directory, publish
+
+class Command(BaseCommand):
+    help = "Writes the ladders as static files to REVIEW_LADDER_SNAPSHOT_DIR"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--directory",
+                            help="Directory to write the snapshots to "
+                                 "(default: REVIEW_LADDER_SNAPSHOT_DIR)")
+
+    def handle(self, *args, **options):
+        directory = options["directory"] or get_directory()
+        if not directory:
+            raise CommandError("REVIEW_LADDER_SNAPSHOT_DIR is not configured")
+        written = publish(directory)
+        self.stdout.write("Wrote %d snapshots to %s" % (written, directory))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from review_ladder.db import primary
+from review_ladder.models import DailyScore
+
+class Command(BaseCommand):
+    help = "Rebuilds the per-user daily score rollup from all comments and merges"
+
+    def handle(self, *args, **options):
+        with primary():
+            buckets = DailyScore.rebuild()
+        self.stdout.write("Rebuilt %d daily score buckets" % buckets)
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import time
+
+from review_ladder.db import primary
+from review_ladder.eventstore import get_store, rebuild
+from review_ladder.models import GITHUB_REPOS
+from review_ladder.snapshots import update
+
+class Command(BaseCommand):
+    help = "Replaces the PRs, comments and merges by those replayed from the " \
+           "event store, without any request to GitHub"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repo", action="append",
+                            help="Repository to rebuild (default: all)")
+        parser.add_argument("--chunk-size", type=int, default=500,
+                            help="Number of PRs written per bulk write")
+
+    def handle(self, *args, **options):
+        repos = options["repo"] or GITHUB_REPOS
+        for repo in repos:
+            if repo not in GITHUB_REPOS:
+                raise CommandError("%s is not in GITHUB_REPOS" % repo)
+        if get_store() is None:
+            raise CommandError("REVIEW_LADDER_EVENT_STORE is not configured")
+        start = time.time()
+        with primary():
+            replayed = rebuild(repos, chunk_size=options["chunk_size"])
+            update()
+        self.stdout.write("Replayed %d events in %.1f s" %
+                          (replayed, time.time() - start))
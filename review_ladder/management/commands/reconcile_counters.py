@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from review_ladder.models import PullRequest, User
+
+class Command(BaseCommand):
+    help = "Recomputes the denormalized assignment, comment and merge counters"
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            users = User.reconcile_counters()
+            prs = PullRequest.reconcile_counters()
+        self.stdout.write("Repaired the counters of %d users and %d PRs" %
+                          (users, prs))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from review_ladder.github import GithubImporter
+
+class Command(BaseCommand):
+    help = "Runs the importer in this process. Only one importer imports at " \
+           "a time, the others take over if it stops."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=int,
+                            help="Seconds between imports")
+        parser.add_argument("--once", action="store_true",
+                            help="Import once (unless another importer holds "
+                                 "the lease) and exit")
+
+    def handle(self, *args, **options):
+        importer = GithubImporter(interval=options["interval"])
+        try:
+            if options["once"]:
+                if importer.run_once(force=True):
+                    self.stdout.write("Import done")
+                else:
+                    self.stdout.write("Another importer holds the lease")
+            else:
+                importer.run()
+        finally:
+            # let another importer take over right away
+            importer.release()
@@ -0,0 +1,220 @@
+from django.db import connections
+
+import bisect
+import contextlib
+import functools
+import threading
+import time
+
+# Metrics are kept in the memory of each process and exposed in the
+# Prometheus text format by views.metrics.
+
+REGISTRY = []
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n") \
+                     .replace('"', '\\"')
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, _escape(value))
+                             for name, value in pairs)
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+class Metric(object):
+    TYPE = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def samples(self):
+        # yields (suffix, label values, extra labels, value) tuples
+        raise NotImplementedError
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s %s" % (self.name, self.TYPE)]
+        with self.lock:
+            samples = list(self.samples())
+        for suffix, values, extra, value in samples:
+            lines.append("%s%s%s %s" % (self.name, suffix,
+                                        _labels(self.labels, values, extra),
+                                        _number(value)))
+        return "\n".join(lines)
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield "", labels, (), value
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield "", labels, (), value
+
+class Histogram(Metric):
+    TYPE = "histogram"
+    BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # per bucket (not cumulative) counts, the sum and the count
+                counts = self.values[labels] = [0] * (len(self.buckets) + 3)
+            counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def samples(self):
+        for labels, counts in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield "_bucket", labels, [("le", _number(bound))], cumulative
+            yield "_sum", labels, (), counts[-2]
+            yield "_count", labels, (), counts[-1]
+
+def render():
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+GITHUB_REQUESTS = Counter(
+        "review_ladder_github_requests_total",
+        "Requests to GitHub by endpoint and status",
+        ["endpoint", "status"]
+    )
+GITHUB_REQUEST_SECONDS = Histogram(
+        "review_ladder_github_request_seconds",
+        "Duration of requests to GitHub by endpoint",
+        ["endpoint"]
+    )
+GITHUB_SLEEP_SECONDS = Counter(
+        "review_ladder_github_sleep_seconds_total",
+        "Time spent waiting for GitHub's rate limit or before retries",
+        ["reason"]
+    )
+GITHUB_RATE_LIMIT_REMAINING = Gauge(
+        "review_ladder_github_rate_limit_remaining",
+        "Remaining request budget last reported by GitHub",
+        ["resource"]
+    )
+IMPORTS = Counter(
+        "review_ladder_imports_total",
+        "Import runs by result",
+        ["result"]
+    )
+IMPORT_SECONDS = Histogram(
+        "review_ladder_import_seconds",
+        "Duration of import runs",
+        buckets=(1, 10, 30, 60, 5 * 60, 15 * 60, 60 * 60, 4 * 60 * 60)
+    )
+IMPORT_PRS = Histogram(
+        "review_ladder_import_prs",
+        "PRs processed per import run",
+        buckets=(0, 1, 10, 100, 1000, 10000)
+    )
+WEBHOOK_SECONDS = Histogram(
+        "review_ladder_webhook_processing_seconds",
+        "Time to process a webhook delivery by event",
+        ["event"]
+    )
+WEBHOOK_FAILURES = Counter(
+        "review_ladder_webhook_failures_total",
+        "Failed webhook deliveries by whether they are retried",
+        ["result"]
+    )
+VIEW_SECONDS = Histogram(
+        "review_ladder_view_seconds",
+        "Duration of requests by view",
+        ["view"]
+    )
+VIEW_QUERIES = Histogram(
+        "review_ladder_view_db_queries",
+        "Database queries per request by view",
+        ["view"],
+        buckets=(0, 1, 2, 5, 10, 20, 50, 100, 1000)
+    )
+VIEW_DB_SECONDS = Histogram(
+        "review_ladder_view_db_seconds",
+        "Time spent in database queries per request by view",
+        ["view"]
+    )
+
+class _QueryTimer(object):
+    # execute_wrapper (Django >= 2.0) counting queries and their duration
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.time()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.time() - start
+            self.queries += 1
+
+def _call_timed(func, timer, *args, **kwargs):
+    if hasattr(connections["default"], "execute_wrapper"):
+        with contextlib.ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(timer))
+            return func(*args, **kwargs)
+    # older versions only record queries with the debug cursor
+    logs = []
+    for connection in connections.all():
+        logs.append((connection, connection.force_debug_cursor,
+                     len(connection.queries_log)))
+        connection.force_debug_cursor = True
+    try:
+        return func(*args, **kwargs)
+    finally:
+        for connection, force_debug_cursor, start in logs:
+            connection.force_debug_cursor = force_debug_cursor
+            queries = list(connection.queries_log)[start:]
+            timer.queries += len(queries)
+            timer.seconds += sum(float(query["time"]) for query in queries)
+
+def instrument_view(view):
+    # records duration and database queries of each request to view
+    name = view.__name__
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        timer = _QueryTimer()
+        start = time.time()
+        try:
+            return _call_timed(view, timer, *args, **kwargs)
+        finally:
+            VIEW_SECONDS.observe(time.time() - start, name)
+            VIEW_QUERIES.observe(timer.queries, name)
+            VIEW_DB_SECONDS.observe(timer.seconds, name)
+    return wrapper
@@ -1,73 +1,285 @@
-from django.db import models, transaction
-from django.db.models import Q, Count
+from django.db import IntegrityError, models, transaction
+from django.db.models import Q, F, Count, Min, Sum, ExpressionWrapper, FloatField
+from django.db.models import IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.conf import settings
 from django.core import validators
+from django.utils import timezone
 
+import collections
 import datetime
 import dateutil.parser
+import operator
+import uuid
+from functools import reduce
 
-GITHUB_REPO = "%s/%s" % (settings.GITHUB_REPO_USER, settings.GITHUB_REPO_NAME)
+# the repositories (as "owner/name") a deployment ranks, the first one is the
+# default
+GITHUB_REPOS = list(getattr(settings, "GITHUB_REPOS", [])) or \
+               ["%s/%s" % (settings.GITHUB_REPO_USER, settings.GITHUB_REPO_NAME)]
+GITHUB_REPO = GITHUB_REPOS[0]
 
 if hasattr(settings, "GITHUB_SINCE"):
     START_DATE = dateutil.parser.parse(settings.GITHUB_SINCE)
 else:
     START_DATE = datetime.datetime.fromtimestamp(0)
 
+def chunked(iterable, size=400):
+    # splits iterable into lists of at most size elements, e.g. to keep
+    # __in lookups below SQLite's limit of query parameters
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _count(queryset, field):
+    # counts the rows of queryset grouped by field (which is expected to be
+    # bound to an OuterRef), for use with annotate()
+    return Coalesce(Subquery(queryset.order_by()
+                                     .values(field)
+                                     .annotate(num=Count("pk"))
+                                     .values("num"),
+                             output_field=IntegerField()), 0)
+
+def _sum(queryset, field):
+    # like _count, but sums up field instead
+    return Coalesce(Subquery(queryset.order_by()
+                                     .values("user")
+                                     .annotate(num=Sum(field))
+                                     .values("num"),
+                             output_field=IntegerField()), 0)
+
+def apply_counts(model, deltas):
+    # applies a mapping of (primary key, counter field) to the change of that
+    # counter to the rows of model. A key of None is ignored.
+    pks = collections.defaultdict(list)
+    for key, delta in deltas.items():
+        if key and delta:
+            pk, field = key
+            pks[field, delta].append(pk)
+    for (field, delta), ids in pks.items():
+        for chunk in chunked(ids):
+            model.objects.filter(pk__in=chunk) \
+                         .update(**{field: F(field) + delta})
+
+def _reconcile(model, counts):
+    # sets the counter fields in counts to the count expressions they map to
+    # where they differ, returns the number of changed rows
+    actual = dict(("actual_%s" % field, count)
+                  for field, count in counts.items())
+    correct = reduce(operator.and_, [Q(**{field: F("actual_%s" % field)})
+                                     for field in counts])
+    ids = list(model.objects.annotate(**actual).exclude(correct)
+                            .values_list("pk", flat=True))
+    for chunk in chunked(ids):
+        model.objects.filter(pk__in=chunk).update(**counts)
+    return len(ids)
+
+def normalize_date(date):
+    if settings.USE_TZ and timezone.is_naive(date):
+        return timezone.make_aware(date)
+    elif not settings.USE_TZ and timezone.is_aware(date):
+        return timezone.make_naive(date)
+    return date
+
+def day_of(date):
+    # days are bucketed in UTC
+    if timezone.is_aware(date):
+        return date.astimezone(timezone.utc).date()
+    return date.date()
+
+def _midnight(day):
+    midnight = datetime.datetime.combine(day, datetime.time())
+    if settings.USE_TZ:
+        return midnight.replace(tzinfo=timezone.utc)
+    return midnight
+
+def _split_window(since=None, until=None):
+    # splits [since, until] into the whole days within it (a filter on
+    # DailyScore) and the partial days at its edges (a filter on the date of
+    # comments and merges). Either is None if it is empty.
+    days = Q()
+    edges = []
+    if since:
+        since = normalize_date(since)
+        first = day_of(since)
+        if _midnight(first) < since:
+            first += datetime.timedelta(days=1)
+            edges.append(Q(date__gte=since, date__lt=_midnight(first)))
+        days &= Q(day__gte=first)
+    if until:
+        until = normalize_date(until)
+        end = day_of(until)
+        edges.append(Q(date__gte=_midnight(end), date__lte=until))
+        days &= Q(day__lt=end)
+    if since and until and (first >= end):
+        return None, Q(date__gte=since, date__lte=until)
+    return days, reduce(operator.or_, edges) if edges else None
+
 # Create your models here.
 class User(models.Model):
     id = models.IntegerField(primary_key=True, unique=True)
     avatar_url = models.URLField()
     name = models.CharField(max_length=30, unique=True, db_index=True)
+    # denormalized counts of the PRs assigned to the user and the user's
+    # comments (including reviews) and merges
+    assignments_count = models.IntegerField(default=0, db_index=True)
+    comments_count = models.IntegerField(default=0)
+    merges_count = models.IntegerField(default=0)
 
     def __str__(self):
         return self.name
 
-    def _filtered_stats(self, since=None, until=None):
-        comments = self.comments.exclude(pr__author=self)
-        merges = self.merges
+    @classmethod
+    def ranked(cls, since=None, until=None, repo=None):
+        # all stats are computed as correlated subqueries, so the database
+        # builds the whole ranking in one query. Whole days are summed up from
+        # the DailyScore rollup, only partial days at the edges of the window
+        # are counted from the raw comments and merges. Without repo, the
+        # ranking is over all repositories.
+        days, edges = _split_window(since, until)
+        rollup = DailyScore.objects.filter(user=OuterRef("pk"))
+        comments = (Comment.objects
+                           .filter(user=OuterRef("pk"))
+                           .filter(Q(pr__author__isnull=True) |
+                                   ~Q(pr__author=F("user"))))
+        merges = Merge.objects.filter(author=OuterRef("pk"))
+        if repo is not None:
+            rollup = rollup.filter(repo=repo)
+            comments = comments.filter(pr__repo=repo)
+            merges = merges.filter(pr__repo=repo)
 
-        if since:
-            comments = comments.filter(date__gte=since)
-            merges = merges.filter(date__gte=since)
-        if until:
-            comments = comments.filter(date__lte=until)
-            merges = merges.filter(date__lte=until)
-        return comments, merges
+        def stat(field, raw, raw_field):
+            expr = None
+            if days is not None:
+                expr = _sum(rollup.filter(days), field)
+            if edges is not None:
+                raw_count = _count(raw.filter(edges), raw_field)
+                expr = raw_count if expr is None else expr + raw_count
+            return expr
 
-    def score(self, since=None, until=None):
-        comments, merges = self._filtered_stats(since, until)
-        return sum(c.type for c in comments) + (Comment.MRG * merges.count())
+        # users without any comments or merges can't have a score
+        return (cls.objects
+                   .filter(Q(comments_count__gt=0) | Q(merges_count__gt=0))
+                   .annotate(
+                        approvals_num=stat("approvals",
+                                           comments.filter(type=Comment.ACK),
+                                           "user"),
+                        change_requests_num=stat("change_requests",
+                                                 comments.filter(type=Comment.CRQ),
+                                                 "user"),
+                        comments_num=stat("comments",
+                                          comments.filter(type=Comment.COM),
+                                          "user"),
+                        merges_num=stat("merges", merges, "author"),
+                    )
+                   .annotate(score=ExpressionWrapper(
+                        (F("approvals_num") * Comment.ACK) +
+                        (F("change_requests_num") * Comment.CRQ) +
+                        (F("comments_num") * Comment.COM) +
+                        (F("merges_num") * Comment.MRG),
+                        output_field=FloatField()
+                    ))
+                   # score can still be 0 if comments were made in own PR
+                   .filter(score__gt=0)
+                   .order_by("-score", "pk"))
 
-    def stats(self, since=None, until=None):
-        comments, merges = self._filtered_stats(since, until)
+    def ranking_dict(self):
+        # self must stem from ranked()
         return {
-                "approvals": comments.filter(type=Comment.ACK).count(),
-                "change_requests": comments.filter(type=Comment.CRQ).count(),
-                "comments": comments.filter(type=Comment.COM).count(),
-                "merges": merges.count(),
+                "id": self.pk,
+                "name": self.name,
+                "avatar_url": self.avatar_url,
+                "score": self.score,
+                "stats": {
+                    "approvals": self.approvals_num,
+                    "change_requests": self.change_requests_num,
+                    "comments": self.comments_num,
+                    "merges": self.merges_num,
+                }
             }
 
     @classmethod
-    def get_ranking(cls, limit=20, since=None, until=None):
-        maintainers_query = sorted(cls.objects
-                                .annotate(comments_num=Count("comments"))
-                                .annotate(merges_num=Count("merges"))
-                                .filter(Q(comments_num__gt=0) | Q(merges_num__gt=0)),
-                             key=lambda u: u.score(since, until),
-                             reverse=True)
-        maintainers = []
-        for maintainer in maintainers_query:
-            if maintainer.score(since, until):
-                maintainers.append({
-                        "name": maintainer.name,
-                        "avatar_url": maintainer.avatar_url,
-                        "score": maintainer.score(since, until),
-                        "stats": maintainer.stats(since, until)
-                    })
-            if len(maintainers) == limit:
-                break
-        return maintainers
+    def get_ranking(cls, limit=20, since=None, until=None, repo=None,
+                    after=None):
+        # after is the (score, id) of the last maintainer of the previous page
+        from .ranking import get_engine
+
+        engine = get_engine()
+        if engine is not None:
+            return engine.get_ranking(limit, since, until, repo, after)
+        maintainers = cls.ranked(since, until, repo)
+        if after is not None:
+            score, user_id = after
+            maintainers = maintainers.filter(
+                    Q(score__lt=score) | Q(score=score, pk__gt=user_id)
+                )
+        return [maintainer.ranking_dict() for maintainer in maintainers[:limit]]
+
+    @classmethod
+    def get_rank(cls, user_id, since=None, until=None, repo=None):
+        # the ranking dict of one user with its rank or None if the user has
+        # no score in the window. Only the users ahead are counted.
+        from .ranking import get_engine
 
+        engine = get_engine()
+        if engine is not None:
+            return engine.get_rank(user_id, since, until, repo)
+        maintainers = cls.ranked(since, until, repo)
+        maintainer = maintainers.filter(pk=user_id).first()
+        if maintainer is None:
+            return None
+        ahead = maintainers.filter(Q(score__gt=maintainer.score) |
+                                   Q(score=maintainer.score, pk__lt=user_id))
+        return dict(maintainer.ranking_dict(), rank=ahead.count() + 1)
+
+    @classmethod
+    def assigned(cls, repo=None):
+        # users by the number of PRs assigned to them (as assigned_count) in
+        # repo or in all repositories
+        users = cls.objects.filter(assignments_count__gt=0)
+        if repo is None:
+            users = users.annotate(assigned_count=F("assignments_count"))
+        else:
+            Assignment = PullRequest.assignees.through
+            users = (users.annotate(assigned_count=_count(
+                            Assignment.objects.filter(user=OuterRef("pk"),
+                                                      pullrequest__repo=repo),
+                            "user"
+                        ))
+                          .filter(assigned_count__gt=0))
+        return users.order_by("-assigned_count", "pk")
+
+    @classmethod
+    def reconcile_counters(cls):
+        # recomputes the counters, returns the number of users they were off
+        Assignment = PullRequest.assignees.through
+        return _reconcile(cls, {
+                "assignments_count": _count(
+                        Assignment.objects.filter(user=OuterRef("pk")), "user"
+                    ),
+                "comments_count": _count(
+                        Comment.objects.filter(user=OuterRef("pk")), "user"
+                    ),
+                "merges_count": _count(
+                        Merge.objects.filter(author=OuterRef("pk")), "author"
+                    ),
+            })
+
+    @classmethod
+    def move_count(cls, field, old_id, new_id):
+        # moves a count of field from the user old_id to new_id. Either may be
+        # None for added or removed counts.
+        deltas = collections.Counter()
+        if old_id is not None:
+            deltas[old_id, field] -= 1
+        if new_id is not None:
+            deltas[new_id, field] += 1
+        apply_counts(cls, deltas)
 
     @classmethod
     def from_github_json(cls, json_user):
@@ -90,38 +302,80 @@ class PullRequest(models.Model):
     author = models.ForeignKey("User", null=True, blank=True,
                                on_delete=models.SET_NULL)
     assignees = models.ManyToManyField("User", related_name="assignments")
+    assignees_count = models.IntegerField(default=0)
 
     def __str__(self):
         return "%s#%d" % (self.repo, self.number)
 
+    # assignment events and if they add or remove the user in the given field
+    ASSIGNMENT_EVENTS = {
+            "assigned": ("assignee", True),
+            "unassigned": ("assignee", False),
+            "review_requested": ("requested_reviewer", True),
+            "review_request_removed": ("requested_reviewer", False),
+        }
+
+    @classmethod
+    def assignment_changes(cls, json_events):
+        for json_event in json_events:
+            if json_event["event"] in cls.ASSIGNMENT_EVENTS:
+                field, add = cls.ASSIGNMENT_EVENTS[json_event["event"]]
+                # review requests for teams have no requested_reviewer
+                if json_event.get(field):
+                    yield json_event[field], add
+
     @classmethod
-    def from_github_json(cls, json_pr, json_events=[]):
+    def from_github_json(cls, json_pr, json_events=[], repo=GITHUB_REPO):
         with transaction.atomic():
             author, _ = User.from_github_json(json_pr["user"])
             pr, created = cls.objects.update_or_create(
-                    repo=GITHUB_REPO,
+                    repo=repo,
                     number=json_pr["number"],
                     author=author,
                 )
-            for json_event in json_events:
-                assignee = None
-                op = lambda user: None
-                if json_event["event"] == "review_requested":
-                    assignee, _ = User.from_github_json(json_event["requested_reviewer"])
-                    op = pr.assignees.add
-                elif json_event["event"] == "assigned":
-                    assignee, _ = User.from_github_json(json_event["assignee"])
-                    op = pr.assignees.add
-                elif json_event["event"] == "review_request_removed":
-                    assignee, _ = User.from_github_json(json_event["requested_reviewer"])
-                    op = pr.assignees.remove
-                elif json_event["event"] == "assigned":
-                    assignee, _ = User.from_github_json(json_event["assignee"])
-                    op = pr.assignees.remove
-                op(assignee)
-            pr.save()
+            current = set(pr.assignees.values_list("pk", flat=True))
+            assignees = set(current)
+            for json_assignee, add in cls.assignment_changes(json_events):
+                assignee, _ = User.from_github_json(json_assignee)
+                if add:
+                    assignees.add(assignee.pk)
+                else:
+                    assignees.discard(assignee.pk)
+            added = assignees - current
+            removed = current - assignees
+            if added:
+                pr.assignees.add(*added)
+            if removed:
+                pr.assignees.remove(*removed)
+            cls.count_assignments({pr.pk: (added, removed)})
         return pr, created
 
+    @classmethod
+    def count_assignments(cls, changes):
+        # updates the counters for a mapping of PR ids to the ids of the
+        # users added to and removed from its assignees
+        users = collections.Counter()
+        prs = collections.Counter()
+        for pr_id, (added, removed) in changes.items():
+            prs[pr_id, "assignees_count"] += len(added) - len(removed)
+            for user_id in added:
+                users[user_id, "assignments_count"] += 1
+            for user_id in removed:
+                users[user_id, "assignments_count"] -= 1
+        apply_counts(cls, prs)
+        apply_counts(User, users)
+
+    @classmethod
+    def reconcile_counters(cls):
+        # recomputes the counters, returns the number of PRs they were off
+        Assignment = cls.assignees.through
+        return _reconcile(cls, {
+                "assignees_count": _count(
+                        Assignment.objects.filter(pullrequest=OuterRef("pk")),
+                        "pullrequest"
+                    ),
+            })
+
 class Comment(models.Model):
     COM = .1    # comment
     CRQ = 4.0   # change request
@@ -144,18 +398,41 @@ class Comment(models.Model):
                                       (ACK, "approval")),
                              default=COM)
     date = models.DateTimeField()
+    # for the columnar ranking engine to pick up changed rows
+    modified = models.DateTimeField(auto_now=True, null=True, db_index=True)
+
+    STAT_FIELDS = {
+            COM: "comments",
+            CRQ: "change_requests",
+            ACK: "approvals",
+        }
+
+    def daily_score_key(self):
+        if self.pr.author_id == self.user_id:
+            # comments in own PRs are not counted
+            return None
+        return (self.user_id, self.pr.repo, day_of(self.date),
+                self.STAT_FIELDS[self.type])
 
     @classmethod
     def from_github_json(cls, json_comment, pr, type=COM):
         date = dateutil.parser.parse(json_comment["created_at"])
         if date >= START_DATE:
-            user, _ = User.from_github_json(json_comment["user"])
-            return cls.objects.update_or_create(
-                    id=json_comment["id"],
-                    pr=pr,
-                    user=user,
-                    defaults={"type": type, "date": date}
-                )
+            with transaction.atomic():
+                user, _ = User.from_github_json(json_comment["user"])
+                old = (cls.objects.select_related("pr")
+                                  .filter(id=json_comment["id"]).first())
+                comment, created = cls.objects.update_or_create(
+                        id=json_comment["id"],
+                        pr=pr,
+                        user=user,
+                        defaults={"type": type, "date": date}
+                    )
+                DailyScore.move(old.daily_score_key() if old else None,
+                                comment.daily_score_key())
+                User.move_count("comments_count", old.user_id if old else None,
+                                comment.user_id)
+            return comment, created
 
     @classmethod
     def from_github_review_json(cls, json_review, pr):
@@ -166,6 +443,24 @@ class Comment(models.Model):
         return cls.from_github_json(json_review, pr,
                                     cls.JSON_COMMENT_LOT[json_review["state"].lower()])
 
+    @classmethod
+    def dismiss(cls, id):
+        # degrade review to a comment
+        with transaction.atomic():
+            for comment in cls.objects.select_related("pr").filter(id=id):
+                old_key = comment.daily_score_key()
+                comment.type = cls.COM
+                comment.save(update_fields=["type", "modified"])
+                DailyScore.move(old_key, comment.daily_score_key())
+
+    @classmethod
+    def remove(cls, id):
+        with transaction.atomic():
+            for comment in cls.objects.select_related("pr").filter(id=id):
+                DailyScore.move(comment.daily_score_key(), None)
+                User.move_count("comments_count", comment.user_id, None)
+                comment.delete()
+
 class Merge(models.Model):
     sha = models.CharField(max_length=40,
                            validators=[validators.RegexValidator("[a-f0-9A-F]+")],
@@ -173,18 +468,314 @@ class Merge(models.Model):
     pr = models.OneToOneField("PullRequest")
     author = models.ForeignKey("User", related_name="merges")
     date = models.DateTimeField()
+    modified = models.DateTimeField(auto_now=True, null=True, db_index=True)
 
     def __str__(self):
         return self.sha[:7]
 
+    def daily_score_key(self):
+        return (self.author_id, self.pr.repo, day_of(self.date), "merges")
+
     @classmethod
     def from_github_json(cls, json_commit, pr):
         date = dateutil.parser.parse(json_commit["commit"]["author"]["date"])
         if date >= START_DATE:
-            author, _ = User.from_github_json(json_commit["author"])
-            return cls.objects.update_or_create(
-                    sha=json_commit["sha"],
-                    author=author,
-                    pr=pr,
-                    defaults={"date": date}
+            with transaction.atomic():
+                author, _ = User.from_github_json(json_commit["author"])
+                old = (cls.objects.select_related("pr")
+                                  .filter(sha=json_commit["sha"]).first())
+                merge, created = cls.objects.update_or_create(
+                        sha=json_commit["sha"],
+                        author=author,
+                        pr=pr,
+                        defaults={"date": date}
+                    )
+                DailyScore.move(old.daily_score_key() if old else None,
+                                merge.daily_score_key())
+                User.move_count("merges_count", old.author_id if old else None,
+                                merge.author_id)
+            return merge, created
+
+class SyncState(models.Model):
+    repo = models.CharField(max_length=100, unique=True,
+                            validators=[validators.RegexValidator("[^/]+/[^/]+")])
+    # PRs updated before this were already imported
+    watermark = models.DateTimeField()
+
+    def __str__(self):
+        return "%s@%s" % (self.repo, self.watermark)
+
+    @classmethod
+    def watermark_for(cls, repo):
+        state = cls.objects.filter(repo=repo).first()
+        return state.watermark if state else None
+
+# Rollup of the stats of a user per repository and (UTC) day, so rankings
+# don't need to scan all comments and merges ever made
+class DailyScore(models.Model):
+    class Meta:
+        unique_together = (("user", "repo", "day"), )
+
+    user = models.ForeignKey("User", on_delete=models.CASCADE,
+                             related_name="daily_scores")
+    repo = models.CharField(max_length=100, default=GITHUB_REPO,
+                            validators=[validators.RegexValidator("[^/]+/[^/]+")])
+    day = models.DateField(db_index=True)
+    approvals = models.IntegerField(default=0)
+    change_requests = models.IntegerField(default=0)
+    comments = models.IntegerField(default=0)
+    merges = models.IntegerField(default=0)
+
+    def __str__(self):
+        return "%s@%s@%s" % (self.user_id, self.repo, self.day)
+
+    @classmethod
+    def apply(cls, deltas):
+        # applies a mapping of (user, repo, day, stat field) to the change of
+        # that stat to the rollup. A key of None (not counted) is ignored.
+        buckets = collections.defaultdict(dict)
+        for key, delta in deltas.items():
+            if key and delta:
+                user_id, repo, day, field = key
+                buckets[user_id, repo, day][field] = delta
+        if not buckets:
+            return
+        existing = {}
+        # three __in lookups, each with up to 333 parameters
+        for keys in chunked(buckets, 333):
+            for daily in cls.objects.filter(
+                        user_id__in=set(user_id for user_id, _, _ in keys),
+                        repo__in=set(repo for _, repo, _ in keys),
+                        day__in=set(day for _, _, day in keys),
+                    ).only("pk", "user", "repo", "day"):
+                existing[daily.user_id, daily.repo, daily.day] = daily.pk
+        new = []
+        for (user_id, repo, day), fields in buckets.items():
+            if (user_id, repo, day) in existing:
+                if not cls._add(fields, pk=existing[user_id, repo, day]):
+                    # rebuilt in the meantime
+                    cls._create_or_add(user_id, repo, day, fields)
+            else:
+                new.append(cls(user_id=user_id, repo=repo, day=day, **fields))
+        try:
+            with transaction.atomic():
+                cls.objects.bulk_create(new)
+        except IntegrityError:
+            # another writer (importer or webhook worker) created some of the
+            # buckets in the meantime
+            for daily in new:
+                cls._create_or_add(daily.user_id, daily.repo, daily.day,
+                                   buckets[daily.user_id, daily.repo,
+                                           daily.day])
+
+    @classmethod
+    def _add(cls, fields, **lookup):
+        # returns the number of updated buckets
+        return cls.objects.filter(**lookup).update(
+                **{field: F(field) + delta for field, delta in fields.items()}
+            )
+
+    @classmethod
+    def _create_or_add(cls, user_id, repo, day, fields):
+        if cls._add(fields, user_id=user_id, repo=repo, day=day):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(user_id=user_id, repo=repo, day=day,
+                                   **fields)
+        except IntegrityError:
+            cls._add(fields, user_id=user_id, repo=repo, day=day)
+
+    @classmethod
+    def move(cls, old_key, new_key):
+        # moves a count from the bucket identified by old_key (user, repo,
+        # day, stat field) to new_key. Either may be None for added or removed
+        # counts.
+        deltas = collections.Counter()
+        deltas[old_key] -= 1
+        deltas[new_key] += 1
+        cls.apply(deltas)
+
+    @classmethod
+    def rebuild(cls):
+        counts = collections.defaultdict(collections.Counter)
+        with transaction.atomic():
+            # deleting first makes writers that add to the rollup wait until
+            # the rebuilt one is committed, so what they add is not lost
+            cls.objects.all().delete()
+            comments = (Comment.objects.values_list("user", "pr__author",
+                                                    "pr__repo", "date",
+                                                    "type"))
+            for user, pr_author, repo, date, type in comments.iterator():
+                if user != pr_author:
+                    field = Comment.STAT_FIELDS[type]
+                    counts[user, repo, day_of(date)][field] += 1
+            for author, repo, date in (Merge.objects
+                                            .values_list("author", "pr__repo",
+                                                         "date")
+                                            .iterator()):
+                counts[author, repo, day_of(date)]["merges"] += 1
+            cls.objects.bulk_create(
+                    (cls(user_id=user, repo=repo, day=day, **stats)
+                     for (user, repo, day), stats in counts.items()),
+                    batch_size=500
                 )
+        return len(counts)
+
+class WebhookDelivery(models.Model):
+    MAX_ATTEMPTS = 5
+
+    delivery = models.CharField(max_length=64, unique=True)  # X-GitHub-Delivery
+    event = models.CharField(max_length=50)
+    payload = models.TextField()
+    received = models.DateTimeField(auto_now_add=True, db_index=True)
+    claimed = models.DateTimeField(null=True, blank=True)
+    claimed_by = models.CharField(max_length=32, blank=True, db_index=True)
+    processed = models.DateTimeField(null=True, blank=True, db_index=True)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    # failed deliveries are retried after this
+    not_before = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return "%s (%s)" % (self.delivery, self.event)
+
+    @classmethod
+    def enqueue(cls, delivery, event, payload):
+        _, created = cls.objects.get_or_create(
+                delivery=delivery,
+                defaults={"event": event, "payload": payload}
+            )
+        return created
+
+    @classmethod
+    def claim(cls, batch_size=100, timeout=datetime.timedelta(minutes=5)):
+        # claims the oldest pending deliveries for the calling worker, that
+        # are not waiting to be retried. Claims of workers that did not finish
+        # within timeout are taken over.
+        token = uuid.uuid4().hex
+        now = timezone.now()
+        pending = (Q(processed__isnull=True, attempts__lt=cls.MAX_ATTEMPTS) &
+                   (Q(claimed__isnull=True) | Q(claimed__lt=now - timeout)) &
+                   (Q(not_before__isnull=True) | Q(not_before__lte=now)))
+        ids = list(cls.objects.filter(pending)
+                              .order_by("received", "pk")
+                              .values_list("pk", flat=True)[:batch_size])
+        if not ids:
+            return []
+        cls.objects.filter(pending, pk__in=ids).update(claimed=now,
+                                                        claimed_by=token)
+        return list(cls.objects.filter(claimed_by=token)
+                               .order_by("received", "pk"))
+
+# A range of pages of the PR listing (oldest first) imported by the backfill
+# command. Pages before next_page are already imported.
+class BackfillShard(models.Model):
+    class Meta:
+        unique_together = (("repo", "first_page"), )
+
+    repo = models.CharField(max_length=100,
+                            validators=[validators.RegexValidator("[^/]+/[^/]+")])
+    first_page = models.IntegerField()
+    last_page = models.IntegerField()
+    next_page = models.IntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "%s:%d-%d@%d" % (self.repo, self.first_page, self.last_page,
+                                self.next_page)
+
+    @property
+    def done(self):
+        return self.next_page > self.last_page
+
+    @classmethod
+    def plan(cls, repo, pages, shards):
+        # splits pages into shards of consecutive pages, keeping an existing
+        # plan to resume it
+        existing = list(cls.objects.filter(repo=repo).order_by("first_page"))
+        if existing:
+            return existing
+        size = max(1, -(-pages // shards))  # rounded up
+        return [cls.objects.create(repo=repo, first_page=first,
+                                   last_page=min(first + size - 1, pages),
+                                   next_page=first)
+                for first in range(1, pages + 1, size)]
+
+# PRs that could not be imported, to be retried
+class FailedImport(models.Model):
+    class Meta:
+        unique_together = (("repo", "number"), )
+
+    repo = models.CharField(max_length=100,
+                            validators=[validators.RegexValidator("[^/]+/[^/]+")])
+    number = models.IntegerField()
+    error = models.TextField(blank=True)
+    attempts = models.IntegerField(default=1)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "%s#%d" % (self.repo, self.number)
+
+    @classmethod
+    def record(cls, repo, number, error):
+        failed, created = cls.objects.get_or_create(
+                repo=repo, number=number, defaults={"error": error}
+            )
+        if not created:
+            cls.objects.filter(pk=failed.pk).update(
+                    error=error, attempts=F("attempts") + 1,
+                    updated=timezone.now()
+                )
+
+# Held by the one process (across the deployment) that may do a job, e.g.
+# importing, until it expires. The holder has to renew it in time to keep it.
+class Lease(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    holder = models.CharField(max_length=100)
+    expires = models.DateTimeField()
+
+    def __str__(self):
+        return "%s by %s until %s" % (self.name, self.holder, self.expires)
+
+    @classmethod
+    def acquire(cls, name, holder, duration):
+        # acquires or renews the lease for duration seconds, returns if holder
+        # holds it
+        now = timezone.now()
+        expires = now + datetime.timedelta(seconds=duration)
+        if cls.objects.filter(Q(holder=holder) | Q(expires__lt=now),
+                              name=name).update(holder=holder,
+                                                expires=expires):
+            return True
+        try:
+            with transaction.atomic():
+                cls.objects.create(name=name, holder=holder, expires=expires)
+        except IntegrityError:
+            return False
+        return True
+
+    @classmethod
+    def release(cls, name, holder):
+        cls.objects.filter(name=name, holder=holder) \
+                   .update(expires=timezone.now())
+
+def missing_denormalized():
+    # if the daily score rollup or the counters were not filled after an
+    # upgrade from a version without them (which left them empty or at 0)
+    counted = Comment.objects.filter(Q(pr__author__isnull=True) |
+                                     ~Q(pr__author=F("user")))
+    merges = Merge.objects.all()
+    oldest = DailyScore.objects.aggregate(day=Min("day"))["day"]
+    if oldest is not None:
+        counted = counted.filter(date__lt=_midnight(oldest))
+        merges = merges.filter(date__lt=_midnight(oldest))
+    return counted.exists() or merges.exists() or \
+           User.objects.filter(comments_count=0,
+                               comments__isnull=False).exists() or \
+           User.objects.filter(merges_count=0, merges__isnull=False).exists() or \
+           User.objects.filter(assignments_count=0,
+                               assignments__isnull=False).exists() or \
+           PullRequest.objects.filter(assignees_count=0,
+                                      assignees__isnull=False).exists()
@@ -0,0 +1,276 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+import calendar
+import datetime
+import logging
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import cache
+from .db import primary
+from .models import Comment, Merge, User, normalize_date
+
+LOGGER = logging.getLogger(__name__)
+
+def _microseconds(date):
+    date = normalize_date(date)
+    return (calendar.timegm(date.utctimetuple()) * 1000000) + date.microsecond
+
+class _Events(object):
+    # All scoring events sorted by date, as columns: the date (microseconds
+    # since the epoch), the dense index of the user (into user_ids), the stat
+    # and the index of the repository (into repos). Everything needed to tell
+    # updated or deleted rows from new ones is kept alongside.
+    def __init__(self):
+        self.dates = numpy.zeros(0, dtype=numpy.int64)
+        self.users = numpy.zeros(0, dtype=numpy.int32)
+        self.stats = numpy.zeros(0, dtype=numpy.int8)
+        self.repos = numpy.zeros(0, dtype=numpy.int16)
+        self.user_ids = []
+        self.user_index = {}
+        self.repo_names = []
+        # sorted ids of all loaded comments (including those not counted)
+        self.comment_ids = numpy.zeros(0, dtype=numpy.int64)
+        self.merge_shas = set()
+        self.modified = None
+        self.generation = None
+        self.names = {}
+
+    def copy(self):
+        events = _Events()
+        events.__dict__.update(self.__dict__)
+        events.user_ids = list(self.user_ids)
+        events.user_index = dict(self.user_index)
+        events.repo_names = list(self.repo_names)
+        events.merge_shas = set(self.merge_shas)
+        return events
+
+    def _user(self, user_id):
+        index = self.user_index.get(user_id)
+        if index is None:
+            index = self.user_index[user_id] = len(self.user_ids)
+            self.user_ids.append(user_id)
+        return index
+
+    def repo_index(self, repo):
+        if repo not in self.repo_names:
+            self.repo_names.append(repo)
+        return self.repo_names.index(repo)
+
+    def _changed(self, modified, watermark):
+        # a row loaded before is seen again. It changed unless it is only
+        # within the overlap of the refresh.
+        return (modified is None) or (watermark is None) or \
+               (modified > watermark)
+
+    def _seen(self, modified):
+        if (modified is not None) and \
+           ((self.modified is None) or (modified > self.modified)):
+            self.modified = modified
+
+    def append(self, comments, merges):
+        # appends the rows of the comments and merges querysets, returns False
+        # if one of them was loaded before but changed since
+        watermark = self.modified
+        dates, users, stats, repos, comment_ids = [], [], [], [], []
+        for id, user_id, author_id, repo, type, date, modified in \
+                comments.values_list("id", "user", "pr__author", "pr__repo",
+                                     "type", "date", "modified").iterator():
+            i = numpy.searchsorted(self.comment_ids, id)
+            if (i < len(self.comment_ids)) and (self.comment_ids[i] == id):
+                if self._changed(modified, watermark):
+                    return False
+                continue
+            comment_ids.append(id)
+            self._seen(modified)
+            if user_id == author_id:
+                # comments in own PRs are not counted
+                continue
+            dates.append(_microseconds(date))
+            users.append(self._user(user_id))
+            stats.append(Engine.STATS.index(Comment.STAT_FIELDS[type]))
+            repos.append(self.repo_index(repo))
+        for sha, author_id, repo, date, modified in \
+                merges.values_list("sha", "author", "pr__repo", "date",
+                                   "modified").iterator():
+            if sha in self.merge_shas:
+                if self._changed(modified, watermark):
+                    return False
+                continue
+            self.merge_shas.add(sha)
+            self._seen(modified)
+            dates.append(_microseconds(date))
+            users.append(self._user(author_id))
+            stats.append(Engine.STATS.index("merges"))
+            repos.append(self.repo_index(repo))
+        if comment_ids:
+            self.comment_ids = numpy.sort(numpy.concatenate(
+                    [self.comment_ids, numpy.array(comment_ids, dtype=numpy.int64)]
+                ))
+        if dates:
+            dates = numpy.concatenate([self.dates,
+                                       numpy.array(dates, dtype=numpy.int64)])
+            order = numpy.argsort(dates, kind="mergesort")
+            self.dates = dates[order]
+            self.users = numpy.concatenate(
+                    [self.users, numpy.array(users, dtype=numpy.int32)]
+                )[order]
+            self.stats = numpy.concatenate(
+                    [self.stats, numpy.array(stats, dtype=numpy.int8)]
+                )[order]
+            self.repos = numpy.concatenate(
+                    [self.repos, numpy.array(repos, dtype=numpy.int16)]
+                )[order]
+        return True
+
+class Engine(object):
+    # Answers rankings from all scoring events held in memory as NumPy arrays:
+    # the window is found by binary search in the dates and the stats of all
+    # users are counted at once with bincount. The events are reloaded
+    # whenever the cache generation changed, incrementally from the rows
+    # modified since the last load unless rows were changed or deleted.
+    STATS = ["approvals", "change_requests", "comments", "merges"]
+    WEIGHTS = [Comment.ACK, Comment.CRQ, Comment.COM, Comment.MRG]
+    # rows are committed a bit after they were modified
+    OVERLAP = datetime.timedelta(minutes=1)
+
+    def __init__(self):
+        if numpy is None:
+            raise ImproperlyConfigured("The columnar ranking engine requires "
+                                       "NumPy")
+        self.events = None
+        self.lock = threading.Lock()
+
+    def _load(self, events):
+        events = self._load_events(events)
+        # users are few, so their names are simply reloaded
+        events.names = dict((id, (name, avatar_url))
+                            for id, name, avatar_url in
+                            User.objects.values_list("id", "name",
+                                                     "avatar_url"))
+        return events
+
+    def _load_events(self, events):
+        generation = cache.generation()
+        comments = Comment.objects.all()
+        merges = Merge.objects.all()
+        if events is not None:
+            events = events.copy()
+            if events.modified is not None:
+                since = events.modified - self.OVERLAP
+                comments = comments.filter(modified__gte=since)
+                merges = merges.filter(modified__gte=since)
+            if events.append(comments, merges) and \
+               (len(events.comment_ids) == Comment.objects.count()) and \
+               (len(events.merge_shas) == Merge.objects.count()):
+                events.generation = generation
+                return events
+            LOGGER.debug("Rows were changed or deleted, reloading all events")
+            comments = Comment.objects.all()
+            merges = Merge.objects.all()
+        events = _Events()
+        events.append(comments, merges)
+        events.generation = generation
+        return events
+
+    def refresh(self):
+        events = self.events
+        if (events is not None) and (events.generation == cache.generation()):
+            return events
+        with self.lock:
+            if (self.events is events) or (self.events is None):
+                # like the cache, from the database the generation is about
+                with primary():
+                    self.events = self._load(self.events)
+            return self.events
+
+    def _scores(self, since=None, until=None, repo=None):
+        # the stats (one row per user) and the scores of all users in the
+        # window
+        events = self.refresh()
+        start = 0
+        end = len(events.dates)
+        if since:
+            start = numpy.searchsorted(events.dates, _microseconds(since),
+                                       side="left")
+        if until:
+            end = numpy.searchsorted(events.dates, _microseconds(until),
+                                     side="right")
+        users = events.users[start:end]
+        stats = events.stats[start:end]
+        if repo is not None:
+            # events of unknown repositories can't be selected
+            selected = events.repos[start:end] == (
+                    events.repo_names.index(repo)
+                    if repo in events.repo_names else -1
+                )
+            users = users[selected]
+            stats = stats[selected]
+        counts = numpy.bincount(
+                (users.astype(numpy.int64) * len(self.STATS)) + stats,
+                minlength=len(events.user_ids) * len(self.STATS)
+            ).reshape(len(events.user_ids), len(self.STATS))
+        # summed up in the same order as in User.ranked() to get the same
+        # floating point results
+        scores = numpy.zeros(len(events.user_ids))
+        for i, weight in enumerate(self.WEIGHTS):
+            scores = scores + (counts[:, i] * weight)
+        user_ids = numpy.array(events.user_ids, dtype=numpy.int64)
+        return events, counts, scores, user_ids
+
+    def _ranking_dict(self, events, counts, scores, user_ids, i):
+        name, avatar_url = events.names[int(user_ids[i])]
+        return {
+                "id": int(user_ids[i]),
+                "name": name,
+                "avatar_url": avatar_url,
+                "score": float(scores[i]),
+                "stats": dict((stat, int(counts[i, j]))
+                              for j, stat in enumerate(self.STATS)),
+            }
+
+    def get_ranking(self, limit=20, since=None, until=None, repo=None,
+                    after=None):
+        events, counts, scores, user_ids = self._scores(since, until, repo)
+        selected = scores > 0
+        if after is not None:
+            score, user_id = after
+            selected &= (scores < score) | \
+                        ((scores == score) & (user_ids > user_id))
+        candidates = numpy.nonzero(selected)[0]
+        order = numpy.lexsort((user_ids[candidates], -scores[candidates]))
+        return [self._ranking_dict(events, counts, scores, user_ids, i)
+                for i in candidates[order[:limit]]]
+
+    def get_rank(self, user_id, since=None, until=None, repo=None):
+        events, counts, scores, user_ids = self._scores(since, until, repo)
+        i = events.user_index.get(user_id)
+        if (i is None) or (scores[i] <= 0):
+            return None
+        ahead = (scores > scores[i]) | \
+                ((scores == scores[i]) & (user_ids < user_id))
+        return dict(self._ranking_dict(events, counts, scores, user_ids, i),
+                    rank=int(numpy.count_nonzero(ahead)) + 1)
+
+_ENGINE = None
+_ENGINE_LOCK = threading.Lock()
+
+def get_engine():
+    # the configured ranking engine or None to rank in the database
+    global _ENGINE
+
+    name = getattr(settings, "REVIEW_LADDER_RANKING_ENGINE", "database")
+    if name == "database":
+        return None
+    elif name != "columnar":
+        raise ImproperlyConfigured("Unknown ranking engine %s" % name)
+    if _ENGINE is None:
+        with _ENGINE_LOCK:
+            if _ENGINE is None:
+                _ENGINE = Engine()
+    return _ENGINE
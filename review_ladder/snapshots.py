@@ -0,0 +1,86 @@
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.template.loader import render_to_string
+from django.urls import reverse
+
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from . import cache
+from .models import GITHUB_REPOS
+from .views import _url, assignments_context, index_context, ranking_data
+
+# The ladders with the default window are written as static files to
+# REVIEW_LADDER_SNAPSHOT_DIR whenever the data changed, so a web server can
+# serve them without asking Django. The files mirror the URLs below the
+# URLconf of the application (e.g. assignments/index.html,
+# RIOT-OS/RIOT/ranking.json), requests with parameters still have to be
+# passed on to the views.
+
+LOGGER = logging.getLogger(__name__)
+
+_published = None
+_lock = threading.Lock()
+
+def get_directory():
+    return getattr(settings, "REVIEW_LADDER_SNAPSHOT_DIR", None)
+
+def _path(directory, url):
+    # the file a web server serves for url
+    path = url[len(reverse("score")):]
+    if (path == "") or path.endswith("/"):
+        path += "index.html"
+    return os.path.join(directory, *path.split("/"))
+
+def _write(path, content):
+    # readers either see the old or the new file, never a partial one
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".snapshot-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content.encode("utf-8"))
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+def publish(directory=None):
+    # writes the snapshots of all ladders, returns the number of files
+    directory = directory or get_directory()
+    written = 0
+    for repo in [None] + GITHUB_REPOS:
+        _write(_path(directory, _url("score", repo)),
+               render_to_string("review_ladder/index.html",
+                                index_context(repo)))
+        _write(_path(directory, _url("assignments", repo)),
+               render_to_string("review_ladder/assignments.html",
+                                assignments_context(repo)))
+        _write(_path(directory, _url("ranking", repo)),
+               json.dumps(ranking_data(repo), cls=DjangoJSONEncoder))
+        written += 3
+    return written
+
+def update():
+    # publishes the snapshots if configured and the data changed since they
+    # were last published by this process
+    global _published
+
+    if not get_directory():
+        return False
+    with _lock:
+        generation = cache.generation()
+        if generation == _published:
+            return False
+        try:
+            publish()
+        except Exception:
+            LOGGER.exception("Publishing the snapshots failed")
+            return False
+        _published = generation
+    return True
@@ -1,3 +1,630 @@
-from django.test import TestCase
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import OperationalError, connections
+from django.http import HttpResponse
+from django.test import TestCase, override_settings
+from django.utils import timezone
 
-# Create your tests here.
+import datetime
+import functools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from .bench.fakegithub import FakeGithub
+from .bench.synthetic import SyntheticRepository
+from .models import GITHUB_REPOS, Comment, DailyScore, Merge, PullRequest, User
+from .models import BackfillShard, FailedImport, Lease, SyncState, _midnight
+from .models import WebhookDelivery
+from .views import HANDLERS, ranking_data
+from .writer import BulkWriter
+from . import backfill, cache, github, graphql, history, ranking, snapshots
+from . import db, webhooks
+
+class RankingTest(TestCase):
+    def setUp(self):
+        self.repository = SyntheticRepository(users=30, prs=150, seed=1)
+        self.repository.populate()
+        # webhook edits on top of the import
+        self.repository.last_id = 10 ** 6
+        for event, payload in self.repository.webhook_payloads(30):
+            HANDLERS[event](payload)
+        for review in Comment.objects.exclude(type=Comment.COM)[:5]:
+            Comment.dismiss(review.pk)
+        for comment in Comment.objects.filter(type=Comment.COM)[:5]:
+            Comment.remove(comment.pk)
+        # a new author of a PR flips which of its comments are own ones
+        data = next(data for data in self.repository.prs.values()
+                    if any(json_comment["user"] == data["pr"]["user"]
+                           for json_comment in data["comments"]) and
+                       any(json_comment["user"] != data["pr"]["user"]
+                           for json_comment in data["comments"]))
+        data["pr"]["user"] = next(json_comment["user"]
+                                  for json_comment in data["comments"]
+                                  if json_comment["user"] != data["pr"]["user"])
+        writer = BulkWriter(self.repository.repo)
+        writer.add(data)
+        writer.flush()
+
+    @staticmethod
+    def per_user_ranking(since=None, until=None):
+        # how the ladder was computed before, one user at a time
+        ranking = []
+        for user in User.objects.all():
+            comments = user.comments.exclude(pr__author=user)
+            merges = user.merges.all()
+            if since:
+                comments = comments.filter(date__gte=since)
+                merges = merges.filter(date__gte=since)
+            if until:
+                comments = comments.filter(date__lte=until)
+                merges = merges.filter(date__lte=until)
+            score = sum(c.type for c in comments) + \
+                    (Comment.MRG * merges.count())
+            if score > 0:
+                ranking.append((user, score, {
+                        "approvals": comments.filter(type=Comment.ACK).count(),
+                        "change_requests": comments.filter(type=Comment.CRQ)
+                                                   .count(),
+                        "comments": comments.filter(type=Comment.COM).count(),
+                        "merges": merges.count(),
+                    }))
+        ranking.sort(key=lambda entry: (-round(entry[1], 6), entry[0].pk))
+        return ranking
+
+    def windows(self):
+        now = timezone.now()
+        return [
+                (None, None),
+                (now - datetime.timedelta(days=30, hours=5), None),
+                (now - datetime.timedelta(days=400, hours=3),
+                 now - datetime.timedelta(days=100, hours=7)),
+            ]
+
+    def assertRanking(self, expected, ranking):
+        self.assertEqual([user.name for user, _, _ in expected],
+                         [maintainer["name"] for maintainer in ranking])
+        for (_, score, stats), maintainer in zip(expected, ranking):
+            self.assertAlmostEqual(score, maintainer["score"])
+            self.assertEqual(stats, maintainer["stats"])
+
+    def test_ranking_matches_per_user_scoring(self):
+        for since, until in self.windows():
+            self.assertRanking(self.per_user_ranking(since, until),
+                               User.get_ranking(1000, since, until))
+
+    @unittest.skipIf(ranking.numpy is None, "NumPy is not installed")
+    def test_columnar_ranking_matches_database(self):
+        engine = ranking.Engine()
+        for since, until in self.windows():
+            self.assertEqual(User.get_ranking(1000, since, until),
+                             engine.get_ranking(1000, since, until))
+
+    def test_history_matches_ranking_per_window(self):
+        until = datetime.datetime.utcnow().date()
+        since = until - datetime.timedelta(days=200)
+        for bucket, window in [("day", None), ("week", None), ("month", None),
+                               ("week", 30), ("month", 90)]:
+            data = history.history(since, until, bucket, window, limit=1000)
+            ranges = history.bucket_ranges(since, until, bucket)
+            self.assertEqual(len(ranges), len(data["buckets"]))
+            for i, (start, end) in enumerate(ranges):
+                if window:
+                    start = end - datetime.timedelta(days=window - 1)
+                expected = User.get_ranking(
+                        1000, _midnight(start),
+                        _midnight(end + datetime.timedelta(days=1)) -
+                        datetime.timedelta(microseconds=1)
+                    )
+                ranks = dict((maintainer["name"],
+                              (maintainer["ranks"][i],
+                               round(maintainer["scores"][i], 6)))
+                             for maintainer in data["maintainers"]
+                             if maintainer["ranks"][i])
+                self.assertEqual(dict((maintainer["name"],
+                                       (rank, round(maintainer["score"], 6)))
+                                      for rank, maintainer
+                                      in enumerate(expected, 1)),
+                                 ranks, (bucket, window, start))
+
+    def test_rollup_matches_rebuild(self):
+        fields = ["user", "repo", "day", "approvals", "change_requests",
+                  "comments", "merges"]
+        # the rollup may keep buckets that were counted down to 0
+        kept = sorted(DailyScore.objects.exclude(approvals=0,
+                                                 change_requests=0,
+                                                 comments=0, merges=0)
+                                        .values_list(*fields))
+        DailyScore.rebuild()
+        self.assertEqual(kept, sorted(DailyScore.objects.values_list(*fields)))
+
+    def test_counters_match_reconcile(self):
+        self.assertEqual(0, User.reconcile_counters())
+        self.assertEqual(0, PullRequest.reconcile_counters())
+
+class ImportTest(TestCase):
+    def setUp(self):
+        self.repository = SyntheticRepository(users=10, prs=20, seed=2)
+        # a review request for a team has no requested_reviewer
+        self.repository.prs[1]["events"].append({
+                "event": "review_requested",
+                "requested_team": {"name": "maintainers"},
+            })
+        self.fake = FakeGithub(self.repository)
+        self.fake.start()
+        self.addCleanup(self.fake.stop)
+
+    @staticmethod
+    def imported():
+        assignees = PullRequest.assignees.through.objects
+        return (
+                sorted(PullRequest.objects.values_list("number", "author",
+                                                       "assignees_count")),
+                sorted(assignees.values_list("pullrequest__number", "user")),
+                sorted(Comment.objects.values_list("id", "user", "type",
+                                                   "date")),
+                sorted(Merge.objects.values_list("sha", "author", "date")),
+                sorted(User.objects.values_list("id", "name",
+                                                "assignments_count",
+                                                "comments_count",
+                                                "merges_count")),
+            )
+
+    def import_models(self, backend):
+        with override_settings(GITHUB_API=self.fake.url,
+                               GITHUB_IMPORT_BACKEND=backend), \
+             mock.patch.object(graphql, "GITHUB_GRAPHQL_API",
+                               "%s/graphql" % self.fake.url):
+            self.assertTrue(github.import_models(incremental=False,
+                                                 workers=1))
+        return self.imported()
+
+    def test_graphql_import_matches_rest(self):
+        rest = self.import_models("rest")
+        for model in [Merge, Comment, DailyScore, PullRequest, User]:
+            model.objects.all().delete()
+        self.assertEqual(rest, self.import_models("graphql"))
+        self.assertFalse(User.objects.filter(name=graphql.GHOST["login"])
+                                     .exists())
+
+class WebhookQueueTest(TestCase):
+    @staticmethod
+    def payload(number, review=None):
+        payload = {
+                "action": "submitted",
+                "repository": {"full_name": "owner/repo"},
+                "pull_request": {"number": number},
+            }
+        if review is not None:
+            payload["review"] = {"id": review}
+        return json.dumps(payload)
+
+    def enqueue(self, delivery, number, review):
+        WebhookDelivery.enqueue(delivery, "pull_request_review",
+                                self.payload(number, review))
+
+    def process(self, side_effect=None):
+        # processes the queue once, returns the deliveries handled
+        handled = []
+
+        def handler(data):
+            handled.append((data["pull_request"]["number"],
+                            data["review"]["id"]))
+            if side_effect:
+                raise side_effect
+            return HttpResponse("Done")
+
+        with mock.patch.dict(HANDLERS, {"pull_request_review": handler}):
+            webhooks.process_queue()
+        return handled
+
+    def test_enqueue_and_claim(self):
+        self.assertTrue(WebhookDelivery.enqueue("a", "pull_request", "{}"))
+        self.assertFalse(WebhookDelivery.enqueue("a", "pull_request", "{}"))
+        WebhookDelivery.enqueue("b", "pull_request", "{}")
+        self.assertEqual(["a", "b"], [delivery.delivery for delivery in
+                                      WebhookDelivery.claim()])
+        self.assertEqual([], WebhookDelivery.claim())
+        # claims of workers that did not finish in time are taken over
+        self.assertEqual(2, len(WebhookDelivery.claim(
+                timeout=datetime.timedelta(0)
+            )))
+
+    def test_coalesce_keeps_first_position(self):
+        deliveries = [WebhookDelivery(delivery=delivery,
+                                      event="pull_request_review",
+                                      payload=self.payload(number, review))
+                      for delivery, number, review in [("a", 1, 10),
+                                                       ("b", 2, 20),
+                                                       ("c", 1, 11),
+                                                       ("d", 1, 10)]]
+        prs, superseded, malformed = webhooks.coalesce(deliveries)
+        self.assertEqual([("owner/repo", 1), ("owner/repo", 2)], list(prs))
+        self.assertEqual(["d", "c"], [delivery.delivery for delivery, _ in
+                                      prs["owner/repo", 1].values()])
+        self.assertEqual(["a"], [delivery.delivery
+                                 for delivery in superseded])
+        self.assertEqual([], malformed)
+
+    def test_failed_delivery_is_retried_until_given_up(self):
+        self.enqueue("a", 1, 10)
+        self.enqueue("b", 1, 11)
+        self.enqueue("c", 2, 20)
+        self.assertEqual([(1, 10), (2, 20)], self.process(RuntimeError()))
+        a, b, c = WebhookDelivery.objects.order_by("delivery")
+        self.assertEqual(1, a.attempts)
+        self.assertGreater(a.not_before, timezone.now())
+        # the next delivery of the same PR waits for the retry
+        self.assertEqual((0, a.not_before), (b.attempts, b.not_before))
+        self.assertEqual(1, c.attempts)
+        # not retried before the backoff ran out
+        self.assertEqual([], self.process(RuntimeError()))
+        for attempt in range(2, WebhookDelivery.MAX_ATTEMPTS + 1):
+            WebhookDelivery.objects.update(not_before=None)
+            self.assertEqual([(1, 10), (2, 20)], self.process(RuntimeError()))
+        WebhookDelivery.objects.update(not_before=None)
+        # b is processed once a was given up
+        self.assertEqual([(1, 11)], self.process())
+        a, b, c = WebhookDelivery.objects.order_by("delivery")
+        self.assertEqual([WebhookDelivery.MAX_ATTEMPTS, 0,
+                          WebhookDelivery.MAX_ATTEMPTS],
+                         [a.attempts, b.attempts, c.attempts])
+        self.assertEqual([None, None], [a.processed, c.processed])
+        self.assertIsNotNone(b.processed)
+        self.assertEqual([], self.process())
+        # given up deliveries are removed after the retention
+        WebhookDelivery.objects.update(received=timezone.now() -
+                                                webhooks.RETENTION * 2)
+        self.enqueue("d", 3, 30)
+        self.assertEqual([(3, 30)], self.process())
+        self.assertEqual(["b", "d"], sorted(WebhookDelivery.objects
+                                            .values_list("delivery",
+                                                         flat=True)))
+
+    def test_malformed_deliveries_are_dropped(self):
+        WebhookDelivery.enqueue("a", "pull_request_review", "not JSON")
+        WebhookDelivery.enqueue("b", "pull_request_review",
+                                json.dumps({"action": "submitted"}))
+        self.enqueue("c", 1, 10)
+        self.assertEqual([(1, 10)], self.process())
+        for delivery in WebhookDelivery.objects.filter(delivery__in=["a", "b"]):
+            self.assertEqual(WebhookDelivery.MAX_ATTEMPTS, delivery.attempts)
+            self.assertEqual("Malformed payload", delivery.error)
+            self.assertIsNone(delivery.processed)
+        self.assertEqual([], self.process())
+
+class RateLimitTest(TestCase):
+    @staticmethod
+    def response(resource, remaining):
+        response = mock.Mock(status_code=200, url="", text="")
+        response.headers = {
+                "x-ratelimit-remaining": str(remaining),
+                "x-ratelimit-reset": str(int(time.time()) + 3600),
+                "x-ratelimit-resource": resource,
+            }
+        return response
+
+    def test_budgets_are_limited_separately(self):
+        client = github.GithubClient(auth=None)
+        client.session.request = mock.Mock(side_effect=[
+                self.response("core", 4000), self.response("search", 0),
+            ])
+        client.get("https://api.github.com/repos/owner/repo/pulls")
+        client.get("https://api.github.com/search/issues")
+        self.assertEqual(4000, client.limiter("core").remaining)
+        self.assertGreater(client.limiter("core").rate, 1)
+        self.assertEqual(0, client.limiter("search").remaining)
+        self.assertGreater(client.limiter("search").blocked_until,
+                           time.time())
+        self.assertEqual(0, client.limiter("core").blocked_until)
+
+HTTP_CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "review_ladder_tests",
+        },
+        "github": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "review_ladder_tests_github",
+        },
+    }
+
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        self.repository = SyntheticRepository(users=5, prs=20, seed=3)
+        self.fake = FakeGithub(self.repository, per_page=7)
+        self.fake.start()
+        self.addCleanup(self.fake.stop)
+        overridden = override_settings(GITHUB_API=self.fake.url,
+                                     CACHES=HTTP_CACHES,
+                                     GITHUB_HTTP_CACHE="github")
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        caches["github"].clear()
+        self.url = "%s/repos/%s/pulls/1" % (self.fake.url,
+                                            self.repository.repo)
+
+    def test_unchanged_response_is_taken_from_the_cache(self):
+        body, _ = github.conditional_get(self.url)
+        self.assertEqual(body, github.conditional_get(self.url)[0])
+        self.assertEqual({("pull", 200): 1, ("pull", 304): 1},
+                         dict(self.fake.requests))
+
+    def test_changed_or_missing_response_is_fetched(self):
+        github.conditional_get(self.url)
+        self.repository.prs[1]["pr"]["state"] = "closed"
+        self.assertEqual("closed", github.conditional_get(self.url)[0]["state"])
+        caches["github"].clear()
+        self.assertEqual("closed", github.conditional_get(self.url)[0]["state"])
+        self.assertEqual({("pull", 200): 3}, dict(self.fake.requests))
+        # and cached again
+        github.conditional_get(self.url)
+        self.assertEqual(1, self.fake.requests["pull", 304])
+
+    def test_nothing_is_cached_without_a_cache(self):
+        with override_settings(GITHUB_HTTP_CACHE=None):
+            github.conditional_get(self.url)
+            github.conditional_get(self.url)
+        self.assertEqual({("pull", 200): 2}, dict(self.fake.requests))
+        for alias in ["default", "unknown"]:
+            with override_settings(GITHUB_HTTP_CACHE=alias), \
+                 self.assertRaises(ImproperlyConfigured):
+                github.conditional_get(self.url)
+
+    def test_pagination_follows_the_last_page(self):
+        self.assertEqual(3, github.last_page(
+                '<https://api.github.com/x?page=2>; rel="next", '
+                '<https://api.github.com/x?state=all&page=3>; rel="last"'
+            ))
+        self.assertEqual(5, github.last_page(None, 5))
+        url = "%s/repos/%s/pulls" % (self.fake.url, self.repository.repo)
+        for _ in range(2):
+            numbers = [json_pr["number"] for json_pr in
+                       github.github_json_pagination(url, {"state": "all"})]
+            self.assertEqual(sorted(self.repository.prs), sorted(numbers))
+        # the pages (and so the last page) come from the cache the second time
+        self.assertEqual({("pulls", 200): 3, ("pulls", 304): 3},
+                         dict(self.fake.requests))
+
+@override_settings(CACHES={"default": HTTP_CACHES["default"]})
+class CacheTest(TestCase):
+    def setUp(self):
+        cache.get_cache().clear()
+
+    def test_none_is_cached(self):
+        func = mock.Mock(return_value=None)
+        for _ in range(2):
+            self.assertIsNone(cache.cached("test", func, "none"))
+        self.assertEqual(1, func.call_count)
+
+    def test_unranked_user_is_not_recomputed(self):
+        SyntheticRepository(users=5, prs=10, seed=4).populate()
+        user = User.objects.create(id=10 ** 6, name="unranked")
+        with mock.patch.object(User, "get_rank",
+                               wraps=User.get_rank) as get_rank:
+            for _ in range(2):
+                self.assertIsNone(cache.get_rank(user.pk))
+        self.assertEqual(1, get_rank.call_count)
+
+class LeaseTest(TestCase):
+    def expire(self):
+        Lease.objects.update(expires=timezone.now() -
+                                     datetime.timedelta(seconds=1))
+
+    def test_taken_over_after_expiry(self):
+        self.assertTrue(Lease.acquire("job", "a", 60))
+        self.assertFalse(Lease.acquire("job", "b", 60))
+        # renewed by its holder
+        self.assertTrue(Lease.acquire("job", "a", 60))
+        self.expire()
+        self.assertTrue(Lease.acquire("job", "b", 60))
+        self.assertFalse(Lease.acquire("job", "a", 60))
+        Lease.release("job", "b")
+        self.assertTrue(Lease.acquire("job", "a", 60))
+
+    def test_importer_needs_the_lease(self):
+        Lease.acquire(github.IMPORTER_LEASE, "other", 60)
+        importer = github.GithubImporter()
+        self.assertFalse(importer.run_once(force=True))
+        self.assertEqual("other", Lease.objects.get().holder)
+
+    def renew(self, importer):
+        # one round of renewing the lease of importer
+        stop = mock.Mock()
+        stop.wait.side_effect = [False, True]
+        with mock.patch.object(github, "connection"):
+            importer._renew(stop)
+
+    def test_lost_once_taken_over(self):
+        importer = github.GithubImporter(lease=60)
+        Lease.acquire(github.IMPORTER_LEASE, importer.holder, 60)
+        self.renew(importer)
+        self.assertFalse(importer.lost.is_set())
+        self.expire()
+        Lease.acquire(github.IMPORTER_LEASE, "other", 60)
+        self.renew(importer)
+        self.assertTrue(importer.lost.is_set())
+
+    def test_lost_once_renewing_failed_for_the_duration(self):
+        with mock.patch.object(Lease, "acquire",
+                               side_effect=OperationalError("locked")):
+            importer = github.GithubImporter(lease=60)
+            self.renew(importer)
+            # might still be held
+            self.assertFalse(importer.lost.is_set())
+            importer.lease = 0
+            self.renew(importer)
+            self.assertTrue(importer.lost.is_set())
+
+class BackfillTest(TestCase):
+    PER_PAGE = 10
+
+    def setUp(self):
+        self.repository = SyntheticRepository(users=5, prs=40, seed=5)
+        self.repo = self.repository.repo
+        self.fake = FakeGithub(self.repository)
+        self.fake.start()
+        self.addCleanup(self.fake.stop)
+        overridden = override_settings(GITHUB_API=self.fake.url)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        # smaller pages, so there are several
+        patcher = mock.patch.object(backfill, "json_pr_page",
+                                    functools.partial(github.json_pr_page,
+                                                      per_page=self.PER_PAGE))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def page(self, page):
+        # the numbers of the PRs on a page of the listing, oldest first
+        prs = self.fake._prs({"direction": "asc"})
+        return set(json_pr["number"] for json_pr in
+                   prs[(page - 1) * self.PER_PAGE:page * self.PER_PAGE])
+
+    def imported(self):
+        return set(PullRequest.objects.values_list("number", flat=True))
+
+    def test_resumes_from_checkpoint(self):
+        # an interrupted backfill that imported the first page
+        first, second = BackfillShard.plan(self.repo, 4, 2)
+        BackfillShard.objects.filter(pk=first.pk).update(next_page=2)
+        progress = backfill.backfill(workers=2, repo=self.repo)
+        self.assertEqual((3, 30, 0),
+                         (progress.done, progress.prs, progress.failed))
+        self.assertEqual(self.page(2) | self.page(3) | self.page(4),
+                         self.imported())
+        # the listing of the pages to count them and of the remaining ones
+        self.assertEqual(4, self.fake.requests["pulls", 200])
+        self.assertFalse(BackfillShard.objects.exists())
+        self.assertIsNotNone(SyncState.watermark_for(self.repo))
+
+    def test_failed_prs_are_retried(self):
+        broken = min(self.page(1))
+
+        def fetch_pr(json_pr, repo):
+            if json_pr["number"] == broken:
+                raise ValueError("broken")
+            return github.fetch_pr(json_pr, repo)
+
+        # the worker processes are forked with the patch in place
+        with mock.patch.object(backfill, "fetch_pr", fetch_pr):
+            progress = backfill.backfill(workers=2, repo=self.repo)
+        self.assertEqual((39, 1), (progress.prs, progress.failed))
+        self.assertEqual([broken], list(FailedImport.objects
+                                                    .values_list("number",
+                                                                 flat=True)))
+        self.assertNotIn(broken, self.imported())
+        FailedImport.record(self.repo, 10 ** 6, "not found")
+        progress = backfill.retry_failed(self.repo)
+        self.assertEqual((2, 1, 1),
+                         (progress.done, progress.prs, progress.failed))
+        self.assertIn(broken, self.imported())
+        self.assertEqual([(10 ** 6, 2)], list(FailedImport.objects.values_list(
+                "number", "attempts"
+            )))
+
+@override_settings(CACHES={"default": HTTP_CACHES["default"]})
+class SnapshotTest(TestCase):
+    def setUp(self):
+        cache.get_cache().clear()
+        SyntheticRepository(users=5, prs=20, seed=6).populate()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        patcher = mock.patch.object(snapshots, "_published", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def files(self):
+        files = []
+        for path, _, names in os.walk(self.directory):
+            files.extend(os.path.relpath(os.path.join(path, name),
+                                         self.directory) for name in names)
+        return sorted(files)
+
+    def test_publish(self):
+        self.assertEqual(3 * (1 + len(GITHUB_REPOS)),
+                         snapshots.publish(self.directory))
+        expected = []
+        for repo in [None] + GITHUB_REPOS:
+            prefix = [repo] if repo else []
+            expected.extend(os.path.join(*(prefix + name)) for name in
+                            [["index.html"], ["assignments", "index.html"],
+                             ["ranking.json"]])
+        self.assertEqual(sorted(expected), self.files())
+        with open(os.path.join(self.directory, "ranking.json")) as f:
+            self.assertEqual(json.loads(json.dumps(ranking_data(),
+                                                   cls=DjangoJSONEncoder)),
+                             json.load(f))
+
+    def test_update_publishes_changes_once(self):
+        self.assertFalse(snapshots.update())
+        with override_settings(REVIEW_LADDER_SNAPSHOT_DIR=self.directory):
+            self.assertTrue(snapshots.update())
+            os.unlink(os.path.join(self.directory, "ranking.json"))
+            # nothing changed since
+            self.assertFalse(snapshots.update())
+            self.assertNotIn("ranking.json", self.files())
+            cache._bump_generation()
+            self.assertTrue(snapshots.update())
+            self.assertIn("ranking.json", self.files())
+
+class RouterTest(TestCase):
+    def setUp(self):
+        for patcher in [mock.patch.object(db, "READ_DATABASE", "read"),
+                        # the test itself runs in an atomic block
+                        mock.patch.object(connections[db.WRITE_DATABASE],
+                                          "in_atomic_block", False)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.router = db.Router()
+
+    def test_reads(self):
+        for model in [Comment, DailyScore, Merge, PullRequest, User,
+                      PullRequest.assignees.through]:
+            self.assertEqual("read", self.router.db_for_read(model))
+        for model in [WebhookDelivery, SyncState, Lease, BackfillShard]:
+            self.assertEqual("default", self.router.db_for_read(model))
+        # other apps are left to the other routers
+        other = mock.Mock(_meta=mock.Mock(app_label="auth", model_name="user"))
+        self.assertIsNone(self.router.db_for_read(other))
+        self.assertIsNone(self.router.db_for_write(other))
+
+    def test_writes(self):
+        for model in [PullRequest, WebhookDelivery]:
+            self.assertEqual("default", self.router.db_for_write(model))
+        self.assertTrue(self.router.allow_migrate("default", "review_ladder"))
+        self.assertFalse(self.router.allow_migrate("read", "review_ladder"))
+
+    def test_primary(self):
+        with db.primary():
+            self.assertEqual("default", self.router.db_for_read(User))
+            with db.primary():
+                self.assertEqual("default", self.router.db_for_read(User))
+            self.assertEqual("default", self.router.db_for_read(User))
+        self.assertEqual("read", self.router.db_for_read(User))
+
+    def test_primary_is_per_thread(self):
+        entered, done = threading.Event(), threading.Event()
+
+        def other():
+            with db.primary():
+                entered.set()
+                done.wait(5)
+        thread = threading.Thread(target=other)
+        thread.start()
+        entered.wait(5)
+        try:
+            self.assertEqual("read", self.router.db_for_read(User))
+        finally:
+            done.set()
+            thread.join()
+
+    def test_atomic_block_reads_primary(self):
+        connections[db.WRITE_DATABASE].in_atomic_block = True
+        self.assertEqual("default", self.router.db_for_read(User))
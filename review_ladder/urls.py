@@ -1,9 +1,24 @@
 from django.conf.urls import url
 
-from .views import index, assignments, webhook
+from .views import index, assignments, history_json, history_view
+from .views import metrics_view, rank, ranking, webhook
 
 urlpatterns = [
     url("^$", index, name="score"),
     url("^assignments/$", assignments, name="assignments"),
-    url("^webhook/?$", webhook)
+    url(r"^ranking\.json$", ranking, name="ranking"),
+    url(r"^rank\.json$", rank, name="rank"),
+    url("^history/$", history_view, name="history"),
+    url(r"^history\.json$", history_json, name="history_json"),
+    url("^webhook/?$", webhook, name="webhook"),
+    url("^metrics$", metrics_view, name="metrics"),
+    # the same views for one of the repositories ("owner/name")
+    url(r"^(?P<repo>[^/]+/[^/]+)/$", index, name="repo_score"),
+    url(r"^(?P<repo>[^/]+/[^/]+)/assignments/$", assignments,
+        name="repo_assignments"),
+    url(r"^(?P<repo>[^/]+/[^/]+)/ranking\.json$", ranking, name="repo_ranking"),
+    url(r"^(?P<repo>[^/]+/[^/]+)/rank\.json$", rank, name="repo_rank"),
+    url(r"^(?P<repo>[^/]+/[^/]+)/history/$", history_view, name="repo_history"),
+    url(r"^(?P<repo>[^/]+/[^/]+)/history\.json$", history_json,
+        name="repo_history_json"),
 ]
@@ -1,64 +1,304 @@
 from django.conf import settings
-from django.db import transaction
-from django.db.models import Q, Count
-from django.http import HttpResponse, HttpResponseForbidden
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse
 from django.http import HttpResponseBadRequest, HttpResponseServerError
-from django.views.decorators.cache import cache_page
-from django.views.decorators.http import require_POST, require_GET
+from django.views.decorators.http import condition, require_POST, require_GET
 from django.shortcuts import render
+from django.urls import reverse
+from django.utils.cache import add_never_cache_headers, patch_cache_control
 from django.utils.encoding import force_bytes, force_str
 from django.views.decorators.csrf import csrf_exempt
 
+import datetime
 import dateutil.parser
+import functools
 import hmac
+import json
+import uuid
 from hashlib import sha1
-from ipaddress import ip_address, ip_network
-try:
-    import simplejson as json
-except ImportError:
-    import json
+from ipaddress import ip_address
 
 # Create your views here.
-from .models import Comment, Merge, PullRequest, User, START_DATE
+from .models import Comment, Merge, PullRequest, User, WebhookDelivery
+from .models import START_DATE
 from .github import *
+from . import cache, eventstore, history, metrics
 
-@require_GET
-def index(request):
+SCORES = {
+        "comment": Comment.COM,
+        "change_request": Comment.CRQ,
+        "approval": Comment.ACK,
+        "merge": Comment.MRG,
+    }
+API_MAX_LIMIT = getattr(settings, "REVIEW_LADDER_API_MAX_LIMIT", 100)
+API_MAX_AGE = getattr(settings, "REVIEW_LADDER_API_MAX_AGE", 60)
+HISTORY_MAX_BUCKETS = getattr(settings, "REVIEW_LADDER_HISTORY_MAX_BUCKETS",
+                              400)
+
+def _window(request):
     since = None
     until = None
     if "since" in request.GET:
         since = dateutil.parser.parse(request.GET["since"])
     if "until" in request.GET:
         until = dateutil.parser.parse(request.GET["until"])
+    return since, until
+
+def _check_repo(repo):
+    # repo of a repository-scoped view, None stands for all repositories
+    if (repo is not None) and (repo not in GITHUB_REPOS):
+        raise Http404("Unknown repository")
+
+def _url(name, repo):
+    if repo is None:
+        return reverse(name)
+    return reverse("repo_%s" % name, kwargs={"repo": repo})
+
+def _context(name, repo):
     context = {
-            "repository": GITHUB_REPO,
-            # score can still be 0 if comments were made in own PR
-            "maintainers": User.get_ranking(since=since, until=until),
-            "scores": {
-                    "comment": Comment.COM,
-                    "change_request": Comment.CRQ,
-                    "approval": Comment.ACK,
-                    "merge": Comment.MRG,
-                }
+            "repository": repo or ", ".join(GITHUB_REPOS),
+            "repo": repo,
+            "github_repo": repo or GITHUB_REPO,
+            "score_url": _url("score", repo),
+            "assignments_url": _url("assignments", repo),
+            "history_url": _url("history", repo),
+            "repositories": [],
         }
+    if len(GITHUB_REPOS) > 1:
+        # the same view for all and each of the repositories
+        context["repositories"] = [(other, _url(name, other))
+                                   for other in [None] + GITHUB_REPOS]
     if hasattr(settings, "GITHUB_SINCE"):
         context["since"] = START_DATE.isoformat()
-    return render(request, "review_ladder/index.html", context)
-
-@cache_page(2 * 60)
-def assignments(request):
-    maintainers = (User.objects
-                            .annotate(assignments_num=Count("assignments"))
-                            .filter(assignments_num__gt=0)
-                            .order_by("-assignments_num"))
-    context = {
-            "repository": GITHUB_REPO,
+    return context
+
+@metrics.instrument_view
+@require_GET
+def index(request, repo=None):
+    _check_repo(repo)
+    since, until = _window(request)
+    return render(request, "review_ladder/index.html",
+                  index_context(repo, since, until))
+
+def index_context(repo=None, since=None, until=None):
+    context = _context("score", repo)
+    context.update({
             # score can still be 0 if comments were made in own PR
-            "maintainers": maintainers.all()[:20],
+            "maintainers": cache.get_ranking(since=since, until=until,
+                                             repo=repo),
+            "scores": SCORES,
+        })
+    return context
+
+@metrics.instrument_view
+def assignments(request, repo=None):
+    _check_repo(repo)
+    return render(request, "review_ladder/assignments.html",
+                  assignments_context(repo))
+
+def assignments_context(repo=None):
+    context = _context("assignments", repo)
+    context["maintainers"] = cache.cached(
+            "assignments", lambda: list(User.assigned(repo)[:20]), repo or "-"
+        )
+    return context
+
+def _cursor(after):
+    # the (score, id) after which a page of the ranking starts and the rank of
+    # its first maintainer, raises ValueError for invalid cursors
+    if after is None:
+        return None, 1
+    score, user_id, rank = after.split(":")
+    if not (0 < float(score) < float("inf")):
+        raise ValueError("Invalid score %s" % score)
+    return (float(score), int(user_id)), int(rank) + 1
+
+def _cacheable(view):
+    # lets clients and proxies cache successful responses, but not errors
+    # about invalid parameters
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            patch_cache_control(response, public=True, max_age=API_MAX_AGE)
+        else:
+            for header in ["ETag", "Last-Modified"]:
+                if response.has_header(header):
+                    del response[header]
+            add_never_cache_headers(response)
+        return response
+    return wrapper
+
+def _ranking_etag(request, repo=None):
+    # changes with every write, so no need to look at the data
+    return sha1(force_bytes("%d:%s:%s" % (cache.generation(), repo,
+                                          request.GET.urlencode()))).hexdigest()
+
+def _ranking_last_modified(request, repo=None):
+    return datetime.datetime.utcfromtimestamp(cache.last_modified())
+
+@metrics.instrument_view
+@require_GET
+@_cacheable
+@condition(etag_func=_ranking_etag, last_modified_func=_ranking_last_modified)
+def ranking(request, repo=None):
+    _check_repo(repo)
+    try:
+        since, until = _window(request)
+        limit = int(request.GET.get("limit", 20))
+        after, first = _cursor(request.GET.get("after"))
+    except (ValueError, OverflowError):
+        return HttpResponseBadRequest("Invalid since, until, limit or after")
+    if not (0 < limit <= API_MAX_LIMIT):
+        return HttpResponseBadRequest("limit must be between 1 and %d" %
+                                      API_MAX_LIMIT)
+    return JsonResponse(ranking_data(repo, since, until, limit, after, first))
+
+def ranking_data(repo=None, since=None, until=None, limit=20, after=None,
+                 first=1):
+    # first is the rank of the first maintainer after the cursor after
+    maintainers = cache.get_ranking(limit=limit, since=since, until=until,
+                                    repo=repo, after=after)
+    ranking = [dict(maintainer, rank=rank) for rank, maintainer in
+               enumerate(maintainers, first)]
+    cursor = None
+    if len(ranking) == limit:
+        cursor = "%r:%d:%d" % (ranking[-1]["score"], ranking[-1]["id"],
+                               ranking[-1]["rank"])
+    if (since is None) and hasattr(settings, "GITHUB_SINCE"):
+        since = START_DATE
+    return {
+            "repository": repo or ", ".join(GITHUB_REPOS),
+            "repositories": [repo] if repo else GITHUB_REPOS,
+            "since": since.isoformat() if since else None,
+            "until": until.isoformat() if until else None,
+            "scores": SCORES,
+            "ranking": ranking,
+            "next": cursor,
         }
-    if hasattr(settings, "GITHUB_SINCE"):
-        context["since"] = START_DATE.isoformat()
-    return render(request, "review_ladder/assignments.html", context)
+
+@metrics.instrument_view
+@require_GET
+@_cacheable
+@condition(etag_func=_ranking_etag, last_modified_func=_ranking_last_modified)
+def rank(request, repo=None):
+    _check_repo(repo)
+    try:
+        since, until = _window(request)
+    except (ValueError, OverflowError):
+        return HttpResponseBadRequest("Invalid since or until")
+    if "user" not in request.GET:
+        return HttpResponseBadRequest("Expecting user")
+    user = User.objects.filter(name=request.GET["user"]).first()
+    if user is None:
+        raise Http404("Unknown user")
+    maintainer = cache.get_rank(user.pk, since=since, until=until, repo=repo)
+    if maintainer is None:
+        # no score in the window, so no rank either
+        maintainer = {
+                "id": user.pk,
+                "name": user.name,
+                "avatar_url": user.avatar_url,
+                "score": 0,
+                "stats": dict((stat, 0) for stat in history.STATS),
+                "rank": None,
+            }
+    if (since is None) and hasattr(settings, "GITHUB_SINCE"):
+        since = START_DATE
+    return JsonResponse({
+            "repository": repo or ", ".join(GITHUB_REPOS),
+            "repositories": [repo] if repo else GITHUB_REPOS,
+            "since": since.isoformat() if since else None,
+            "until": until.isoformat() if until else None,
+            "scores": SCORES,
+            "maintainer": maintainer,
+        })
+
+def _history_params(request):
+    # raises ValueError for invalid parameters
+    bucket = request.GET.get("bucket", "week")
+    if bucket not in history.BUCKETS:
+        raise ValueError("bucket must be one of %s" %
+                         ", ".join(history.BUCKETS))
+    window = None
+    if request.GET.get("window"):
+        window = int(request.GET["window"])
+        if window < 1:
+            raise ValueError("window must be at least 1 day")
+    limit = int(request.GET.get("limit", 10))
+    if not (0 < limit <= API_MAX_LIMIT):
+        raise ValueError("limit must be between 1 and %d" % API_MAX_LIMIT)
+    until = datetime.datetime.utcnow().date()
+    if request.GET.get("until"):
+        until = dateutil.parser.parse(request.GET["until"]).date()
+    if request.GET.get("since"):
+        since = dateutil.parser.parse(request.GET["since"]).date()
+    else:
+        since = history.previous_buckets(until, bucket, 12)
+    if since > until:
+        raise ValueError("since must not be after until")
+    if len(history.bucket_ranges(since, until, bucket)) > HISTORY_MAX_BUCKETS:
+        raise ValueError("at most %d buckets" % HISTORY_MAX_BUCKETS)
+    return since, until, bucket, window, limit
+
+def _history_etag(request, repo=None):
+    # the default window moves with the date, so the resolved one counts
+    try:
+        since, until, _, _, _ = _history_params(request)
+    except (ValueError, OverflowError):
+        return _ranking_etag(request, repo)
+    return sha1(force_bytes("%d:%s:%s:%s:%s" % (
+            cache.generation(), repo, request.GET.urlencode(), since, until
+        ))).hexdigest()
+
+def _history_last_modified(request, repo=None):
+    last_modified = _ranking_last_modified(request, repo)
+    if request.GET.get("until"):
+        return last_modified
+    # until defaults to today, so the history changes at midnight (UTC)
+    return max(last_modified,
+               datetime.datetime.combine(datetime.datetime.utcnow().date(),
+                                         datetime.time()))
+
+def _history(request, repo):
+    since, until, bucket, window, limit = _history_params(request)
+    return cache.get_history(since, until, bucket, window, limit, repo)
+
+@metrics.instrument_view
+@require_GET
+def history_view(request, repo=None):
+    _check_repo(repo)
+    try:
+        data = _history(request, repo)
+    except (ValueError, OverflowError) as e:
+        return HttpResponseBadRequest(str(e))
+    context = _context("history", repo)
+    context.update({
+            "history": data,
+            # for the script in the template, which must not be able to end
+            # the script element
+            "history_json": json.dumps(data).replace("<", "\\u003c")
+                                            .replace(">", "\\u003e")
+                                            .replace("&", "\\u0026"),
+            "buckets": [(bucket, "?bucket=%s%s" % (
+                                bucket,
+                                "&window=%d" % data["window"]
+                                if data["window"] else ""
+                            ))
+                        for bucket in history.BUCKETS],
+        })
+    return render(request, "review_ladder/history.html", context)
+
+@metrics.instrument_view
+@require_GET
+@_cacheable
+@condition(etag_func=_history_etag, last_modified_func=_history_last_modified)
+def history_json(request, repo=None):
+    _check_repo(repo)
+    try:
+        data = _history(request, repo)
+    except (ValueError, OverflowError) as e:
+        return HttpResponseBadRequest(str(e))
+    return JsonResponse(dict(data, repository=repo or ", ".join(GITHUB_REPOS)))
 
 class HttpErrorResponse(Exception):
     def __init__(self, response):
@@ -68,12 +308,8 @@ def verify_request_source(request):
     # Verify if request came from GitHub
     forwarded_for = u'{}'.format(request.META.get('HTTP_X_FORWARDED_FOR'))
     client_ip_address = ip_address(forwarded_for.split(",")[0])
-    whitelist = json_hooks()
 
-    for valid_ip in whitelist:
-        if client_ip_address in ip_network(valid_ip):
-            return
-    else:
+    if client_ip_address not in HOOK_NETWORKS:
         raise HttpErrorResponse(HttpResponseForbidden('Permission denied.'))
 
 def verify_request_signature(request):
@@ -93,56 +329,66 @@ def verify_request_signature(request):
                                force_bytes(signature)):
         raise HttpErrorResponse(HttpResponseForbidden('Permission denied.'))
 
-def handle_pull_request_event(data):
-    if (data["repository"]["full_name"] != GITHUB_REPO):
+def handle_pull_request_event(data, commits=None):
+    repo = data["repository"]["full_name"]
+    if repo not in GITHUB_REPOS:
         return HttpResponseBadRequest("Unexpected data")
     json_pr = data["pull_request"]
     if (data["action"] == "opened") or \
         ((data["action"] == "closed") and json_pr["merged"]):
-        pr, _ = PullRequest.from_github_json(json_pr)
+        pr, _ = PullRequest.from_github_json(json_pr, repo=repo)
         if (data["action"] == "closed") and json_pr["merged"]:
-            c = json_commit(json_pr["merge_commit_sha"])
+            sha = json_pr["merge_commit_sha"]
+            if commits is None:
+                c = json_commit(sha, repo)
+                # HTTP error returns an empty object or the error message
+                if c.get("sha") and c.get("author"):
+                    eventstore.record("commit", repo, c)
+            else:
+                # replayed from the event store
+                c = commits.get(sha, {})
             if (c.get("author")):
                 Merge.from_github_json(c, pr)
-    if (data["action"] in ["assigned", "unassigned", "review_requested",
-                           "review_request_removed"]):
-        if data["action"] in ["assigned", "unnassigned"]:
-            json_assignee = data["assignee"]
-        else:
-            json_assignee = data["requested_reviewer"]
-        with transaction.atomic():
-            pr, _ = PullRequest.from_github_json(json_pr)
-            assignee, _ = User.from_github_json(json_assignee)
-            if data["action"] in ["assigned", "review_requested"]:
-                pr.assignees.add(assignee)
-            else:
-                pr.assignees.remove(assignee)
-            pr.save()
+    if data["action"] in PullRequest.ASSIGNMENT_EVENTS:
+        # the payload has the same shape as an issue event
+        PullRequest.from_github_json(json_pr, [dict(data, event=data["action"])],
+                                     repo)
+    cache.bump_generation()
     return HttpResponse("Done")
 
-def handle_pull_request_review_event(data):
-    if (data["repository"]["full_name"] != GITHUB_REPO):
+def handle_pull_request_review_event(data, commits=None):
+    repo = data["repository"]["full_name"]
+    if repo not in GITHUB_REPOS:
         return HttpResponseBadRequest("Unexpected data")
     json_review = data["review"]
     if data["action"] == "submitted":
-        pr, _ = PullRequest.from_github_json(data["pull_request"])
+        pr, _ = PullRequest.from_github_json(data["pull_request"], repo=repo)
         Comment.from_github_review_json(json_review, pr)
     elif data["action"] == "dismissed":
-        # degrade review to a comment
-        comment = Comment.objects.filter(id=json_review["id"]).update(type=Comment.COM)
+        Comment.dismiss(json_review["id"])
+    cache.bump_generation()
     return HttpResponse("Done")
 
-def handle_pull_request_comment_event(data):
-    if (data["repository"]["full_name"] != GITHUB_REPO):
+def handle_pull_request_comment_event(data, commits=None):
+    repo = data["repository"]["full_name"]
+    if repo not in GITHUB_REPOS:
         return HttpResponseBadRequest("Unexpected data")
     json_comment = data["comment"]
     if data["action"] == "created":
-        pr, _ = PullRequest.from_github_json(data["pull_request"])
+        pr, _ = PullRequest.from_github_json(data["pull_request"], repo=repo)
         Comment.from_github_json(json_comment, pr)
     elif data["action"] == "deleted":
-        Comment.objects.filter(id=json_comment["id"]).delete()
+        Comment.remove(json_comment["id"])
+    cache.bump_generation()
     return HttpResponse("Done")
 
+HANDLERS = {
+        "pull_request": handle_pull_request_event,
+        "pull_request_review": handle_pull_request_review_event,
+        "pull_request_review_comment": handle_pull_request_comment_event,
+    }
+
+@metrics.instrument_view
 @csrf_exempt
 @require_POST
 def webhook(request):
@@ -158,11 +404,17 @@ def webhook(request):
 
     if event == "ping":
         return HttpResponse("pong")
-    elif event == "pull_request":
-        return handle_pull_request_event(json.loads(force_str(request.body)))
-    elif event == "pull_request_review":
-        return handle_pull_request_review_event(json.loads(force_str(request.body)))
-    elif event == "pull_request_review_comment":
-        return handle_pull_request_comment_event(json.loads(force_str(request.body)))
+    elif event in HANDLERS:
+        # processed asynchronously by webhooks.WebhookWorker, redeliveries
+        # are only stored once
+        delivery = request.META.get('HTTP_X_GITHUB_DELIVERY', None) or \
+                str(uuid.uuid4())
+        WebhookDelivery.enqueue(delivery, event, force_str(request.body))
+        return HttpResponse("Accepted", status=202)
 
     return HttpResponse(status=204)
+
+@require_GET
+def metrics_view(request):
+    return HttpResponse(metrics.render(),
+                        content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,163 @@
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F, Q
+from django.utils import timezone
+
+import collections
+import datetime
+import logging
+import threading
+import time
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from .models import WebhookDelivery
+from .views import HANDLERS
+from . import eventstore, metrics, snapshots
+from .db import primary
+
+LOGGER = logging.getLogger(__name__)
+# processed deliveries are kept that long to recognize redeliveries
+RETENTION = datetime.timedelta(
+        days=getattr(settings, "REVIEW_LADDER_WEBHOOK_RETENTION", 7)
+    )
+# failed deliveries are retried after this, doubled with every attempt
+BACKOFF = datetime.timedelta(
+        seconds=getattr(settings, "REVIEW_LADDER_WEBHOOK_BACKOFF", 30)
+    )
+
+def _subject(event, data):
+    # what a delivery is about within its PR
+    if event == "pull_request_review":
+        return data["review"]["id"]
+    elif event == "pull_request_review_comment":
+        return data["comment"]["id"]
+    for field in ["assignee", "requested_reviewer"]:
+        if data.get(field):
+            return data[field]["id"]
+    return None
+
+def coalesce(deliveries):
+    # groups deliveries by PR (in the order they were received) and drops
+    # those superseded by a later delivery with the same event, action and
+    # subject, which takes the place of the first one. Returns the groups, the
+    # superseded and the malformed deliveries
+    prs = collections.OrderedDict()
+    superseded = []
+    malformed = []
+    for delivery in deliveries:
+        try:
+            data = json.loads(delivery.payload)
+            pr = (data["repository"]["full_name"],
+                  data["pull_request"]["number"])
+            key = (delivery.event, data["action"],
+                   _subject(delivery.event, data))
+        except (ValueError, KeyError, TypeError):
+            malformed.append(delivery)
+            continue
+        group = prs.setdefault(pr, collections.OrderedDict())
+        if key in group:
+            superseded.append(group[key][0])
+        # replacing a value keeps its position
+        group[key] = (delivery, data)
+    return prs, superseded, malformed
+
+def process_queue(batch_size=100):
+    # the handlers read what they are about to change from the write database
+    with primary():
+        return _process_queue(batch_size)
+
+def _fail(delivery, error):
+    # returns when the delivery is retried, None if it is given up
+    attempts = delivery.attempts + 1
+    retry = None
+    if attempts < WebhookDelivery.MAX_ATTEMPTS:
+        retry = timezone.now() + (BACKOFF * (2 ** (attempts - 1)))
+        metrics.WEBHOOK_FAILURES.inc(1, "retried")
+    else:
+        LOGGER.error("Giving up on webhook delivery %s after %d attempts" %
+                     (delivery, attempts))
+        metrics.WEBHOOK_FAILURES.inc(1, "dropped")
+    WebhookDelivery.objects.filter(pk=delivery.pk).update(
+            attempts=F("attempts") + 1, error=error, claimed=None,
+            not_before=retry
+        )
+    return retry
+
+def _process_queue(batch_size):
+    deliveries = WebhookDelivery.claim(batch_size)
+    if not deliveries:
+        return 0
+    prs, superseded, malformed = coalesce(deliveries)
+    done = [delivery.pk for delivery in superseded]
+    # the deliveries after a failed one of the same PR wait for its retry
+    released = collections.defaultdict(list)
+    for delivery in malformed:
+        LOGGER.warning("Dropping malformed webhook delivery %s" % delivery)
+        metrics.WEBHOOK_FAILURES.inc(1, "malformed")
+        WebhookDelivery.objects.filter(pk=delivery.pk).update(
+                attempts=WebhookDelivery.MAX_ATTEMPTS,
+                error="Malformed payload"
+            )
+    for pr, group in prs.items():
+        failed = False
+        retry = None
+        for delivery, data in group.values():
+            if failed:
+                # keep the order of events within a PR
+                released[retry].append(delivery.pk)
+                continue
+            start = time.time()
+            try:
+                response = HANDLERS[delivery.event](data)
+            except Exception as e:
+                LOGGER.exception("Processing webhook delivery %s failed" %
+                                 delivery)
+                retry = _fail(delivery, str(e))
+                failed = True
+                continue
+            finally:
+                metrics.WEBHOOK_SECONDS.observe(time.time() - start,
+                                                delivery.event)
+            if response.status_code >= 400:
+                LOGGER.warning("Ignoring webhook delivery %s: %s" %
+                               (delivery, response.content))
+            else:
+                eventstore.record("webhook", data["repository"]["full_name"],
+                                  {"event": delivery.event, "payload": data})
+            done.append(delivery.pk)
+    eventstore.flush()
+    now = timezone.now()
+    WebhookDelivery.objects.filter(pk__in=done).update(processed=now)
+    for retry, ids in released.items():
+        WebhookDelivery.objects.filter(pk__in=ids).update(claimed=None,
+                                                          not_before=retry)
+    # deliveries that were given up are kept as long for inspection
+    WebhookDelivery.objects.filter(
+            Q(processed__lt=now - RETENTION) |
+            Q(processed__isnull=True,
+              attempts__gte=WebhookDelivery.MAX_ATTEMPTS,
+              received__lt=now - RETENTION)
+        ).delete()
+    snapshots.update()
+    return len(deliveries)
+
+class WebhookWorker(threading.Thread):
+    def __init__(self, batch_size=100, interval=1):
+        super(WebhookWorker, self).__init__()
+        self.daemon = True
+        self.batch_size = batch_size
+        self.interval = interval
+
+    def run(self):
+        while True:
+            close_old_connections()
+            try:
+                processed = process_queue(self.batch_size)
+            except Exception:
+                LOGGER.exception("Processing webhook deliveries failed")
+                processed = 0
+            if not processed:
+                time.sleep(self.interval)
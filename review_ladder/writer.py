@@ -0,0 +1,267 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+import collections
+import dateutil.parser
+
+from .models import Comment, DailyScore, Merge, PullRequest, User
+from .models import GITHUB_REPO, START_DATE, apply_counts, chunked, day_of
+
+class BulkWriter(object):
+    # Buffers the data of imported PRs (as returned by github.fetch_pr) and
+    # writes it in chunks, each in one transaction with a handful of bulk
+    # queries. Users are kept in an identity map for the whole run, so they
+    # are only looked up once.
+    RETRIES = 3
+
+    def __init__(self, repo=GITHUB_REPO, chunk_size=None, chunk_rows=None):
+        if chunk_size is None:
+            chunk_size = getattr(settings, "GITHUB_IMPORT_CHUNK_SIZE", 50)
+        if chunk_rows is None:
+            chunk_rows = getattr(settings, "GITHUB_IMPORT_CHUNK_ROWS", 2000)
+        self.repo = repo
+        self.chunk_size = chunk_size
+        self.chunk_rows = chunk_rows
+        self.users = {}
+        self.pending = []
+        self.rows = 0
+
+    def add(self, data):
+        # returns True if the buffer is full and should be flushed. Besides the
+        # PRs, the comments, reviews and events are counted, so a few PRs with
+        # a long history don't hold the write lock for long either.
+        self.pending.append(data)
+        self.rows += 1 + len(data["comments"]) + len(data["reviews"]) + \
+                     len(data["events"])
+        return (len(self.pending) >= self.chunk_size) or \
+               (self.rows >= self.chunk_rows)
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        self.rows = 0
+        if not pending:
+            return
+        for attempt in range(self.RETRIES, -1, -1):
+            try:
+                with transaction.atomic():
+                    self._write(pending)
+                return
+            except IntegrityError:
+                # the webhook worker inserted some of the same users,
+                # comments or merges in the meantime, they are found as
+                # existing when the chunk is written again
+                self.users = {}
+                if not attempt:
+                    raise
+            except Exception:
+                # users created in the rolled back transaction are gone again
+                self.users = {}
+                raise
+
+    def _load_users(self, json_users):
+        missing = {}
+        for json_user in json_users:
+            user = self.users.get(json_user["id"])
+            if (user is None) or (user.name != json_user["login"]) or \
+               (user.avatar_url != json_user["avatar_url"]):
+                missing[json_user["id"]] = json_user
+        new = []
+        for ids in chunked(missing):
+            existing = User.objects.in_bulk(ids)
+            for id in ids:
+                json_user = missing[id]
+                user = existing.get(id)
+                if user is None:
+                    user = User(id=id)
+                    new.append(user)
+                elif (user.name != json_user["login"]) or \
+                     (user.avatar_url != json_user["avatar_url"]):
+                    User.objects.filter(pk=id).update(
+                            name=json_user["login"],
+                            avatar_url=json_user["avatar_url"]
+                        )
+                user.name = json_user["login"]
+                user.avatar_url = json_user["avatar_url"]
+                self.users[id] = user
+        User.objects.bulk_create(new)
+
+    def _move_own_comments(self, pr, author, deltas):
+        # only comments in others' PRs count, so the comments of the old
+        # author start to count and those of the new one stop
+        for user_id, type, date in (Comment.objects
+                                           .filter(pr=pr.pk,
+                                                   user__in=[pr.author_id,
+                                                             author.id])
+                                           .values_list("user", "type",
+                                                        "date")):
+            key = (user_id, self.repo, day_of(date),
+                   Comment.STAT_FIELDS[type])
+            deltas[key] += 1 if user_id == pr.author_id else -1
+
+    def _load_prs(self, pending, deltas):
+        prs = {}
+        for numbers in chunked(pending):
+            for pr in PullRequest.objects.filter(repo=self.repo,
+                                                 number__in=numbers):
+                prs[pr.number] = pr
+        new = []
+        for number, data in pending.items():
+            author = self.users[data["pr"]["user"]["id"]]
+            if number not in prs:
+                new.append(PullRequest(repo=self.repo, number=number,
+                                       author=author))
+            elif prs[number].author_id != author.id:
+                self._move_own_comments(prs[number], author, deltas)
+                PullRequest.objects.filter(pk=prs[number].pk) \
+                                   .update(author=author)
+                # whether the comments count changes with the author
+                Comment.objects.filter(pr=prs[number].pk) \
+                               .update(modified=timezone.now())
+                prs[number].author = author
+        PullRequest.objects.bulk_create(new)
+        # bulk_create() does not set the primary keys on all backends
+        for numbers in chunked([pr.number for pr in new]):
+            for pr in PullRequest.objects.filter(repo=self.repo,
+                                                 number__in=numbers):
+                prs[pr.number] = pr
+        return prs
+
+    def _write_assignees(self, pending, prs):
+        Assignment = PullRequest.assignees.through
+        current = collections.defaultdict(set)
+        for pr_ids in chunked([pr.pk for pr in prs.values()]):
+            for pr_id, user_id in (Assignment.objects
+                                             .filter(pullrequest_id__in=pr_ids)
+                                             .values_list("pullrequest_id",
+                                                          "user_id")):
+                current[pr_id].add(user_id)
+        new = []
+        changes = {}
+        for number, data in pending.items():
+            pr = prs[number]
+            assignees = set(current[pr.pk])
+            for json_assignee, add in \
+                    PullRequest.assignment_changes(data["events"]):
+                if add:
+                    assignees.add(json_assignee["id"])
+                else:
+                    assignees.discard(json_assignee["id"])
+            added = assignees - current[pr.pk]
+            new.extend(Assignment(pullrequest_id=pr.pk, user_id=user_id)
+                       for user_id in added)
+            removed = current[pr.pk] - assignees
+            if removed:
+                Assignment.objects.filter(pullrequest_id=pr.pk,
+                                          user_id__in=removed).delete()
+            changes[pr.pk] = (added, removed)
+        Assignment.objects.bulk_create(new)
+        PullRequest.count_assignments(changes)
+
+    def _write_comments(self, pending, prs, deltas, counts):
+        comments = collections.OrderedDict()
+        for number, data in pending.items():
+            pr = prs[number]
+            for json_comment in data["comments"]:
+                date = dateutil.parser.parse(json_comment["created_at"])
+                comments[json_comment["id"]] = Comment(
+                        id=json_comment["id"], pr=pr,
+                        user=self.users[json_comment["user"]["id"]],
+                        type=Comment.COM, date=date
+                    )
+            for json_review in data["reviews"]:
+                state = json_review["state"].lower()
+                if state not in Comment.JSON_COMMENT_LOT:
+                    # we don't count "pending" etc.
+                    continue
+                date = dateutil.parser.parse(json_review["submitted_at"])
+                comments[json_review["id"]] = Comment(
+                        id=json_review["id"], pr=pr,
+                        user=self.users[json_review["user"]["id"]],
+                        type=Comment.JSON_COMMENT_LOT[state], date=date
+                    )
+        new = []
+        for ids in chunked(comment.id for comment in comments.values()
+                           if comment.date >= START_DATE):
+            existing = (Comment.objects.select_related("pr")
+                                       .in_bulk(ids))
+            for id in ids:
+                comment = comments[id]
+                old = existing.get(id)
+                if old is None:
+                    new.append(comment)
+                elif (old.pr_id, old.user_id, old.type, old.date) != \
+                     (comment.pr.pk, comment.user_id, comment.type,
+                      comment.date):
+                    Comment.objects.filter(pk=id).update(
+                            pr=comment.pr, user=comment.user,
+                            type=comment.type, date=comment.date,
+                            modified=timezone.now()
+                        )
+                    deltas[old.daily_score_key()] -= 1
+                    counts[old.user_id, "comments_count"] -= 1
+                else:
+                    continue
+                deltas[comment.daily_score_key()] += 1
+                counts[comment.user_id, "comments_count"] += 1
+        Comment.objects.bulk_create(new)
+
+    def _write_merges(self, pending, prs, deltas, counts):
+        merges = {}
+        for number, data in pending.items():
+            json_commit = data["commit"]
+            if not json_commit:
+                continue
+            date = dateutil.parser.parse(json_commit["commit"]["author"]["date"])
+            if date >= START_DATE:
+                merges[json_commit["sha"]] = Merge(
+                        sha=json_commit["sha"], pr=prs[number],
+                        author=self.users[json_commit["author"]["id"]],
+                        date=date
+                    )
+        new = []
+        existing = {}
+        for shas in chunked(merges):
+            existing.update(Merge.objects.select_related("pr").in_bulk(shas))
+        for sha, merge in merges.items():
+            old = existing.get(sha)
+            if old is None:
+                new.append(merge)
+            elif (old.pr_id, old.author_id, old.date) != \
+                 (merge.pr.pk, merge.author_id, merge.date):
+                Merge.objects.filter(pk=sha).update(pr=merge.pr,
+                                                    author=merge.author,
+                                                    date=merge.date,
+                                                    modified=timezone.now())
+                deltas[old.daily_score_key()] -= 1
+                counts[old.author_id, "merges_count"] -= 1
+            else:
+                continue
+            deltas[merge.daily_score_key()] += 1
+            counts[merge.author_id, "merges_count"] += 1
+        Merge.objects.bulk_create(new)
+
+    def _write(self, pending):
+        # the same PR may have been listed twice, the last one wins
+        pending = collections.OrderedDict((data["pr"]["number"], data)
+                                          for data in pending)
+        json_users = []
+        for data in pending.values():
+            json_users.append(data["pr"]["user"])
+            json_users.extend(json_assignee for json_assignee, _ in
+                              PullRequest.assignment_changes(data["events"]))
+            json_users.extend(json_comment["user"]
+                              for json_comment in data["comments"])
+            json_users.extend(json_review["user"]
+                              for json_review in data["reviews"])
+            if data["commit"]:
+                json_users.append(data["commit"]["author"])
+        self._load_users(json_users)
+        deltas = collections.Counter()
+        counts = collections.Counter()
+        prs = self._load_prs(pending, deltas)
+        self._write_assignees(pending, prs)
+        self._write_comments(pending, prs, deltas, counts)
+        self._write_merges(pending, prs, deltas, counts)
+        DailyScore.apply(deltas)
+        apply_counts(User, counts)
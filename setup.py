@@ -26,7 +26,8 @@ setup(
     url='https://www.todo.com/',
     author='Martine Lenders',
     author_email='m.lenders@fu-berlin.de',
-    install_requires=["django>=1.11", "python-dateutil", "ipaddress", "requests", "schedule"],
+    install_requires=["django>=1.11", "python-dateutil", "ipaddress", "requests"],
+    extras_require={"columnar": ["numpy"]},
     classifiers=[
         'Environment :: Web Environment',
         'Framework :: Django',